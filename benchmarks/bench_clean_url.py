@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Micro-benchmark of the removal of trackers from URLs
+
+    Compares the tracker removal of twoot before the rule engine (parameter
+    set rebuilt at every call) with clean_url() and clean_urls() on a
+    synthetic corpus of URLs. Verifies that all strategies produce the same
+    URLs.
+
+    Usage: bench_clean_url.py [-n <number of urls>] [-r <rule file>]
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import twoot  # noqa: E402
+
+DOMAINS = ['example.com', 'news.example.org', 'www.youtube.com', 'bit.ly', 'blog.example.net']
+PARAMS = ['id', 'page', 'q', 'lang', 'v', 't', 'ref_src', 'sort']
+
+
+def reference_clean_url(orig_url):
+    """
+    Tracker removal as implemented before the rule engine
+    :param orig_url: url to be cleaned
+    :return: url cleaned
+    """
+    def remove_query(query_str):
+        params_to_remove = set(twoot.TRACKER_RULES_DEFAULT['query'])
+        query_to_clean = dict(parse_qsl(query_str, keep_blank_values=True))
+        query_cleaned = [(k, v) for k, v in query_to_clean.items() if k not in params_to_remove]
+        return urlencode(query_cleaned, doseq=True)
+
+    def remove_fragment(fragment_str):
+        params_to_remove = set(twoot.TRACKER_RULES_DEFAULT['query'] + twoot.TRACKER_RULES_DEFAULT['fragment'])
+        if '=' in fragment_str:
+            fragment_str = fragment_str.split('&')
+            query_cleaned = [i for i in fragment_str if i.split('=')[0] not in params_to_remove]
+            fragment_str = '&'.join(query_cleaned)
+        return fragment_str
+
+    url_parsed = urlparse(orig_url)
+    return urlunparse([
+        url_parsed.scheme,
+        url_parsed.netloc,
+        url_parsed.path,
+        url_parsed.params,
+        remove_query(url_parsed.query),
+        remove_fragment(url_parsed.fragment)
+    ])
+
+
+def build_corpus(count, seed=0):
+    """
+    Generate a reproducible list of URLs with and without trackers
+    About a quarter of URLs are repeated, like links shared by many tweets
+    :param count: number of urls
+    :param seed: seed of the random generator
+    :return: list of urls
+    """
+    rnd = random.Random(seed)
+    trackers = twoot.TRACKER_RULES_DEFAULT['query']
+    urls = []
+    for i in range(count):
+        if urls and rnd.random() < 0.25:
+            urls.append(rnd.choice(urls))
+            continue
+
+        url = 'https://' + rnd.choice(DOMAINS) + '/path/' + str(i)
+        params = [(p, str(rnd.randrange(1000))) for p in rnd.sample(PARAMS, rnd.randrange(4))]
+        if rnd.random() < 0.5:
+            params += [(t, 'x' + str(rnd.randrange(100))) for t in rnd.sample(trackers, rnd.randrange(1, 4))]
+            rnd.shuffle(params)
+        if params:
+            url += '?' + urlencode(params)
+        if rnd.random() < 0.1:
+            url += '#' + rnd.choice(['top', 'mkt_tok=abc&s=1', 'Echobox=123'])
+        urls.append(url)
+
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark removal of trackers from URLs.')
+    parser.add_argument('-n', metavar='<number of urls>', type=int, action='store', default=100000)
+    parser.add_argument('-r', metavar='<rule file>', action='append', default=[])
+    args = vars(parser.parse_args())
+
+    twoot.TOML = {'config': {}, 'options': {'remove_trackers_from_urls': True}}
+
+    urls = build_corpus(args['n'])
+
+    start = time.perf_counter()
+    reference = [reference_clean_url(url) for url in urls]
+    baseline = time.perf_counter() - start
+    print('{:<28} {:>10.3f} s'.format('rebuilt parameter set', baseline))
+
+    start = time.perf_counter()
+    twoot.TRACKER_RULES = twoot.compile_tracker_rules(args['r'])
+    print('{:<28} {:>10.3f} ms'.format('rule compilation', (time.perf_counter() - start) * 1000))
+
+    for name, clean in (('clean_url', lambda u: [twoot.clean_url(url) for url in u]),
+                        ('clean_urls', twoot.clean_urls)):
+        start = time.perf_counter()
+        results = clean(urls)
+        elapsed = time.perf_counter() - start
+
+        # Extra rule files legitimately remove more parameters
+        if not args['r'] and results != reference:
+            print('ERROR: ' + name + ' differs from reference tracker removal')
+            sys.exit(1)
+
+        print('{:<28} {:>10.3f} s  x{:.1f}'.format(name, elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
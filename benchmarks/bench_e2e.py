@@ -0,0 +1,499 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Offline end-to-end benchmark of twoot
+
+    Runs main() of twoot in batch mode against a local HTTP stub that plays
+    the roles of the nitter instance, of the media servers and of the
+    Mastodon API. The stub replays the saved nitter pages of the corpus and
+    accepts media_post / status_post with configurable latency and error
+    injection. Nothing leaves the machine.
+
+    Each run is made in a fresh process and working directory. The report
+    gives the throughput of the runs and the latency of each stage as seen by
+    the stub and as measured by twoot itself (metrics_json_path). Reports
+    saved with -o can be compared with -c, e.g. to compare two versions of
+    twoot:
+        bench_e2e.py -s old/twoot.py -o old.json
+        bench_e2e.py -s new/twoot.py -c old.json
+
+    Usage: bench_e2e.py [-s <twoot.py>] [-C <corpus dir>] [-n <statuses>] [-r <runs>]
+                        [-O <option>=<toml value>] [--nitter-latency <ms>] ...
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+STATUS_BASE_ID = 1800000000000000000
+MASTODON_INSTANCE = 'bench.invalid'
+MASTODON_USER = 'bench@bench.invalid'
+
+# Hosts of media linked from recorded pages. Rewritten to point to the stub
+MEDIA_HOSTS = ['https://video.twimg.com', 'https://pbs.twimg.com']
+
+INSTANCE = {
+    'uri': MASTODON_INSTANCE,
+    'version': '4.2.0',
+    'configuration': {
+        'statuses': {'max_characters': 500, 'max_media_attachments': 4},
+        'media_attachments': {
+            'supported_mime_types': ['image/jpeg', 'image/png', 'image/gif', 'video/mp4'],
+            'image_size_limit': 16 * 1024 * 1024,
+            'video_size_limit': 99 * 1024 * 1024,
+        },
+    },
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Nitter instance, media server and Mastodon API in one server
+    Configuration and statistics are attributes of the server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def route(self):
+        """
+        :return: name of the stage the request belongs to
+        """
+        path = self.path.split('?')[0]
+        if self.command == 'POST' and path.endswith('/media'):
+            return 'media_post'
+        if self.command == 'POST' and path == '/api/v1/statuses':
+            return 'status_post'
+        if path.startswith('/api/v1/media/'):
+            return 'media_poll'
+        if path.startswith('/api/'):
+            return 'mastodon_api'
+        if re.fullmatch(r'/[^/]+/status/\d+', path):
+            return 'nitter_page'
+        return 'media_download'
+
+    def do_HEAD(self):
+        self.handle_request(body=False)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        # Consume body, either with a length or chunked (streamed media)
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            self.rfile.read(int(length))
+        elif self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    break
+        self.handle_request()
+
+    def handle_request(self, body=True):
+        server = self.server
+        start = time.perf_counter()
+        route = self.route()
+
+        latency = server.latency.get(route, 0)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+        with server.lock:
+            failed = server.rng.random() < server.error_rate.get(route, 0)
+
+        if failed:
+            status, content_type, data = server.error_status.get(route, 500), 'application/json', b'{}'
+        else:
+            status, content_type, data = self.respond(route)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+        elapsed = time.perf_counter() - start
+        with server.lock:
+            stats = server.stats.setdefault(route, {'latencies': [], 'errors': 0, 'bytes': 0})
+            stats['latencies'].append(elapsed)
+            stats['bytes'] += len(data) if body else 0
+            if status >= 400:
+                stats['errors'] += 1
+
+    def respond(self, route):
+        """
+        :param route: stage of the request
+        :return: tuple (HTTP status, content type, body)
+        """
+        server = self.server
+        path = self.path.split('?')[0]
+
+        if route == 'nitter_page':
+            status_id = int(path.rsplit('/', 1)[1])
+            page = server.pages[status_id % len(server.pages)]
+            return 200, 'text/html; charset=utf-8', page
+
+        if route == 'media_download':
+            data = server.media.get(path.rsplit('/', 1)[-1], server.default_media)
+            content_type = 'video/mp4' if path.endswith('.mp4') or 'video' in path else 'image/jpeg'
+            return 200, content_type, data
+
+        if route == 'media_post':
+            with server.lock:
+                server.counter += 1
+                media_id = str(server.counter)
+                server.media_ready[media_id] = time.monotonic() + server.processing_time
+            return 200, 'application/json', self.media_json(media_id)
+
+        if route == 'media_poll':
+            return 200, 'application/json', self.media_json(path.rsplit('/', 1)[1])
+
+        if route == 'status_post':
+            with server.lock:
+                server.counter += 1
+                toot_id = str(server.counter)
+            return 200, 'application/json', json.dumps({
+                'id': toot_id,
+                'url': server.base_url + '/@bench/' + toot_id,
+                'created_at': '2023-01-01T00:00:00.000Z',
+            }).encode()
+
+        if path.rstrip('/') in ('/api/v1/instance', '/api/v2/instance'):
+            return 200, 'application/json', json.dumps(INSTANCE).encode()
+
+        return 404, 'application/json', b'{}'
+
+    def media_json(self, media_id):
+        """
+        :param media_id: id of uploaded media
+        :return: JSON of media attachment. url is null while processing is simulated
+        """
+        ready = time.monotonic() >= self.server.media_ready.get(media_id, 0)
+        return json.dumps({
+            'id': media_id,
+            'type': 'image',
+            'url': self.server.base_url + '/media/' + media_id if ready else None,
+        }).encode()
+
+
+def start_stub(args, pages, media):
+    """
+    Start the stub server in a background thread
+    :param args: command line arguments
+    :param pages: list of nitter pages (bytes) served for the statuses
+    :param media: dictionary of media file name -> content served for media
+    :return: server
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.base_url = 'http://127.0.0.1:' + str(server.server_address[1])
+    server.lock = threading.Lock()
+    server.rng = random.Random(args['seed'])
+    server.stats = {}
+    server.counter = 0
+    server.media_ready = {}
+    server.processing_time = args['processing_ms'] / 1000
+    server.latency = {
+        'nitter_page': args['nitter_latency'],
+        'media_download': args['media_latency'],
+        'media_post': args['mastodon_latency'],
+        'media_poll': args['mastodon_latency'],
+        'status_post': args['mastodon_latency'],
+        'mastodon_api': args['mastodon_latency'],
+    }
+    server.error_rate = {
+        'nitter_page': args['nitter_errors'],
+        'media_post': args['mastodon_errors'],
+        'status_post': args['mastodon_errors'],
+    }
+    server.error_status = {'nitter_page': 429, 'media_post': 500, 'status_post': 500}
+    server.default_media = b'\xff\xd8\xff\xe0' + bytes(args['media_kb'] * 1024)
+    server.media = media
+
+    # Media linked by absolute URLs are fetched from the stub too
+    server.pages = []
+    for page in pages:
+        for host in MEDIA_HOSTS:
+            page = page.replace(host.encode(), server.base_url.encode())
+        server.pages.append(page)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_twoot(source, base_url, statuses, options, destinations, work_dir, conn):
+    """
+    Run main() of twoot in batch mode. Executed in a child process
+    :param source: path of twoot.py
+    :param base_url: URL of the stub server
+    :param statuses: list of status URLs
+    :param options: dictionary of option -> TOML value written in the config file
+    :param destinations: number of Mastodon accounts the statuses are posted on
+    :param work_dir: working directory of twoot
+    :param conn: pipe used to send back the result
+    """
+    spec = importlib.util.spec_from_file_location('twoot', source)
+    twoot = importlib.util.module_from_spec(spec)
+    sys.modules['twoot'] = twoot
+    spec.loader.exec_module(twoot)
+
+    from mastodon import Mastodon
+
+    # Point twoot to the stub
+    twoot.NITTER_URLS[:] = [base_url]
+
+    # Versions of twoot with several destinations also pass the destination
+    def login(session, password, *destination):
+        return Mastodon(api_base_url=base_url, access_token='bench', session=session,
+                        version_check_mode='none')
+    twoot.login = login
+
+    os.chdir(work_dir)
+    with open('statuses.txt', 'w') as f:
+        f.write('\n'.join(statuses) + '\n')
+    with open('bench.toml', 'w') as f:
+        f.write('[config]\n')
+        f.write('mastodon_instance = "' + MASTODON_INSTANCE + '"\n')
+        f.write('mastodon_user = "' + MASTODON_USER + '"\n')
+        if destinations > 1:
+            for i in range(destinations):
+                f.write('[[destinations]]\n')
+                f.write('mastodon_instance = "' + MASTODON_INSTANCE + '"\n')
+                f.write('mastodon_user = "' + str(i) + MASTODON_USER + '"\n')
+        f.write('[options]\n')
+        for key, value in options.items():
+            f.write(key + ' = ' + value + '\n')
+
+    sys.argv = ['twoot.py', '-f', 'bench.toml', '-b', 'statuses.txt']
+    out = io.StringIO()
+    exit_code = 0
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(out):
+            twoot.main(sys.argv)
+    except SystemExit as e:
+        exit_code = e.code
+    elapsed = time.perf_counter() - start
+
+    # Metrics written by twoot itself, if this version has them
+    metrics = None
+    if os.path.isfile('metrics.jsonl'):
+        with open('metrics.jsonl') as f:
+            metrics = json.loads(f.read().splitlines()[-1])
+
+    lines = out.getvalue().splitlines()
+    conn.send({
+        'seconds': elapsed,
+        'exit_code': exit_code,
+        'ok': sum(1 for line in lines if line.startswith('OK')),
+        'failed': sum(1 for line in lines if line.startswith('FAILED')),
+        'metrics': metrics,
+    })
+    conn.close()
+
+
+def percentile(values, fraction):
+    """
+    :param values: list of numbers
+    :param fraction: between 0 and 1
+    :return: value below which fraction of values fall (nearest rank)
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def revision(source):
+    """
+    :param source: path of twoot.py
+    :return: git revision of the source, with '+' if modified. None if not known
+    """
+    directory = str(Path(source).resolve().parent)
+    try:
+        rev = subprocess.run(['git', '-C', directory, 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', '-C', directory, 'status', '--porcelain', '--', source],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return rev + ('+' if dirty else '')
+
+
+def compare(report, baseline):
+    """
+    Print the change of each measure between a baseline report and this report
+    :param report: report of this benchmark
+    :param baseline: report loaded from file
+    """
+    def line(name, before, after, unit):
+        if before is None or after is None:
+            return
+        change = (after - before) / before * 100 if before else 0
+        print('{:<28} {:>10.2f} {:>10.2f} {:<9} {:>+7.1f}%'.format(name, before, after, unit, change))
+
+    print()
+    print('{:<28} {:>10} {:>10}'.format('compared to ' + str(baseline.get('revision')), 'before', 'after'))
+    line('throughput', baseline['statuses_per_second'], report['statuses_per_second'], 'status/s')
+    line('run time', baseline['seconds'], report['seconds'], 's')
+    for route, stats in report['stages'].items():
+        before = baseline['stages'].get(route)
+        if before is not None:
+            line(route + ' p50', before['p50_ms'], stats['p50_ms'], 'ms')
+            line(route + ' p95', before['p95_ms'], stats['p95_ms'], 'ms')
+    for stage, stats in report.get('twoot_stages', {}).items():
+        before = baseline.get('twoot_stages', {}).get(stage)
+        if before is not None:
+            line(stage + ' total', before['seconds'], stats['seconds'], 's')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of twoot.')
+    parser.add_argument('-s', metavar='<twoot.py>', action='store', default=str(BENCH_DIR.parent / 'twoot.py'))
+    parser.add_argument('-C', metavar='<corpus dir>', action='store', default=str(BENCH_DIR / 'corpus'))
+    parser.add_argument('-n', metavar='<statuses>', type=int, action='store', default=50)
+    parser.add_argument('-r', metavar='<runs>', type=int, action='store', default=3)
+    parser.add_argument('-O', metavar='<option>=<toml value>', action='append', default=[],
+                        help='Option of twoot, e.g. -O max_concurrent_jobs=8 -O upload_videos=true')
+    parser.add_argument('-o', metavar='<report.json>', action='store', help='Save report')
+    parser.add_argument('-c', metavar='<report.json>', action='store', help='Compare with saved report')
+    parser.add_argument('--nitter-latency', metavar='<ms>', type=float, default=50)
+    parser.add_argument('--media-latency', metavar='<ms>', type=float, default=30)
+    parser.add_argument('--mastodon-latency', metavar='<ms>', type=float, default=80)
+    parser.add_argument('--processing-ms', metavar='<ms>', type=float, default=0,
+                        help='Time during which uploaded media are reported as being processed')
+    parser.add_argument('--nitter-errors', metavar='<rate>', type=float, default=0,
+                        help='Fraction of nitter pages answered with 429')
+    parser.add_argument('--mastodon-errors', metavar='<rate>', type=float, default=0,
+                        help='Fraction of media_post and status_post answered with 500')
+    parser.add_argument('--media-kb', metavar='<KiB>', type=int, default=200)
+    parser.add_argument('--destinations', metavar='<accounts>', type=int, default=1,
+                        help='Number of Mastodon accounts each status is posted on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    corpus = Path(args['C'])
+    pages = [p.read_bytes() for p in sorted(corpus.glob('*.html'))]
+    if not pages:
+        print('No .html page found in ' + args['C'])
+        sys.exit(1)
+    media = {}
+    if (corpus / 'media').is_dir():
+        media = {p.name: p.read_bytes() for p in (corpus / 'media').iterdir() if p.is_file()}
+
+    options = {'log_level': '"WARNING"', 'metrics_json_path': '"metrics.jsonl"'}
+    for option in args['O']:
+        key, _, value = option.partition('=')
+        options[key.strip()] = value.strip()
+
+    # Distinct ids so that no status is skipped as already posted
+    statuses = ['https://x.com/bench/status/' + str(STATUS_BASE_ID + i) for i in range(args['n'])]
+
+    server = start_stub(args, pages, media)
+    ctx = multiprocessing.get_context('spawn')
+    runs = []
+    for i in range(args['r']):
+        with tempfile.TemporaryDirectory(prefix='twoot-bench-') as work_dir:
+            receiver, sender = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=run_twoot,
+                                  args=(args['s'], server.base_url, statuses, options, args['destinations'],
+                                        work_dir, sender))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                print('ERROR: run ' + str(i + 1) + ' of twoot crashed')
+                sys.exit(1)
+            process.join()
+        runs.append(result)
+        print('run {}: {:.2f} s, {} ok, {} failed'.format(i + 1, result['seconds'], result['ok'], result['failed']))
+
+    server.shutdown()
+
+    seconds = statistics.median(run['seconds'] for run in runs)
+    report = {
+        'source': str(Path(args['s']).resolve()),
+        'revision': revision(args['s']),
+        'python': sys.version.split()[0],
+        'parameters': {k: v for k, v in args.items() if k not in ('o', 'c')},
+        'runs': runs,
+        'seconds': seconds,
+        'statuses_per_second': args['n'] / seconds,
+        'stages': {},
+        'twoot_stages': {},
+        'twoot_counters': {},
+    }
+    for route, stats in sorted(server.stats.items()):
+        latencies = stats['latencies']
+        report['stages'][route] = {
+            'requests': len(latencies) / len(runs),
+            'errors': stats['errors'] / len(runs),
+            'bytes': stats['bytes'] / len(runs),
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+        }
+
+    # Time spent in each stage as measured by twoot (median of runs)
+    measured = [run['metrics'] for run in runs if run['metrics'] is not None]
+    if measured:
+        for stage in sorted({stage for metrics in measured for stage in metrics['stages']}):
+            stats = [metrics['stages'].get(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                     for metrics in measured]
+            report['twoot_stages'][stage] = {
+                'executions': statistics.median(stat['count'] for stat in stats),
+                'seconds': statistics.median(stat['seconds'] for stat in stats),
+                'max_ms': statistics.median(stat['max_seconds'] for stat in stats) * 1000,
+            }
+        for counter in sorted({counter for metrics in measured for counter in metrics['counters']}):
+            report['twoot_counters'][counter] = statistics.median(metrics['counters'].get(counter, 0)
+                                                                  for metrics in measured)
+
+    print()
+    print('{:<28} {:>10.2f} status/s ({:.2f} s median run time)'.format('throughput', report['statuses_per_second'],
+                                                                          seconds))
+    print('{:<28} {:>10} {:>8} {:>10} {:>10}'.format('stage (per run)', 'requests', 'errors', 'p50 ms', 'p95 ms'))
+    for route, stats in report['stages'].items():
+        print('{:<28} {:>10.0f} {:>8.0f} {:>10.1f} {:>10.1f}'.format(route, stats['requests'], stats['errors'],
+                                                                      stats['p50_ms'], stats['p95_ms']))
+
+    if report['twoot_stages']:
+        print()
+        print('{:<28} {:>10} {:>8} {:>10} {:>10}'.format('stage (measured by twoot)', 'executions', 'total s',
+                                                          'mean ms', 'max ms'))
+        for stage, stats in report['twoot_stages'].items():
+            mean = stats['seconds'] / stats['executions'] * 1000 if stats['executions'] else 0
+            print('{:<28} {:>10.0f} {:>8.2f} {:>10.1f} {:>10.1f}'.format(stage, stats['executions'],
+                                                                          stats['seconds'], mean, stats['max_ms']))
+        print('counters: ' + ', '.join(k + '=' + str(v) for k, v in report['twoot_counters'].items()))
+
+    if args['o'] is not None:
+        with open(args['o'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args['c'] is not None:
+        with open(args['c']) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Micro-benchmark of the parsing of nitter status pages
+
+    Compares parsing the full page with html.parser (as twoot did before
+    parse_main_tweet()) with parsing only the main tweet subtree with each
+    available backend. Verifies that the text, card and attachments extracted
+    from the main tweet are identical whatever the backend.
+
+    Usage: bench_parser.py [-c <corpus dir>] [-n <iterations>]
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bs4 import BeautifulSoup, FeatureNotFound  # noqa: E402
+
+import twoot  # noqa: E402
+
+NITTER_URL = 'https://nitter.example'
+
+
+def full_page_main_tweet(html):
+    """
+    Parsing strategy used before parse_main_tweet(): build the whole page
+    :param html: text of nitter status page
+    :return: soup of main tweet
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    return soup.body.find('div', attrs={'class': 'main-tweet'})
+
+
+def restricted_main_tweet(html):
+    """
+    :param html: text of nitter status page
+    :return: soup of main tweet built by twoot with the configured backend
+    """
+    return twoot.parse_main_tweet(html)
+
+
+def extract(main_tweet):
+    """
+    Run the extraction functions of twoot on the main tweet
+    :param main_tweet: soup of main tweet
+    :return: tuple (text, card pictures, attachment pictures)
+    """
+    status = main_tweet.find('div', attrs={'class': 'timeline-item'})
+    text = twoot.process_media_body(None, status.find('div', class_='tweet-content media-body').children)
+
+    card = []
+    card_class = status.find('a', class_='card-container')
+    if card_class is not None:
+        card = twoot.process_card(NITTER_URL, card_class)
+
+    pics = []
+    attachments_class = status.find('div', class_='attachments')
+    if attachments_class is not None:
+        pics, vid = twoot.process_attachments(None, NITTER_URL, attachments_class, '0', 'bench')
+
+    return text, card, pics
+
+
+def time_strategy(parse, pages, iterations):
+    """
+    :param parse: function returning the soup of the main tweet from a page
+    :param pages: list of page texts
+    :param iterations: number of times each page is parsed
+    :return: average seconds per page
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for page in pages:
+            extract(parse(page))
+    return (time.perf_counter() - start) / (iterations * len(pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing of nitter status pages.')
+    parser.add_argument('-c', metavar='<corpus dir>', action='store',
+                        default=os.path.join(os.path.dirname(__file__), 'corpus'))
+    parser.add_argument('-n', metavar='<iterations>', type=int, action='store', default=50)
+    args = vars(parser.parse_args())
+
+    pages = [p.read_text(encoding='utf-8') for p in sorted(Path(args['c']).glob('*.html'))]
+    if not pages:
+        print('No .html page found in ' + args['c'])
+        sys.exit(1)
+
+    # Minimal configuration: no network access during extraction
+    twoot.TOML = {'config': {}, 'options': {
+        'remove_link_redirections': False,
+        'remove_trackers_from_urls': True,
+        'subst_twitter': [],
+        'subst_youtube': [],
+        'subst_reddit': [],
+        'upload_videos': False,
+        'html_parser': 'html.parser',
+    }}
+
+    reference = [extract(full_page_main_tweet(page)) for page in pages]
+    baseline = time_strategy(full_page_main_tweet, pages, args['n'])
+    print('{:<28} {:>10.3f} ms/page'.format('full page, html.parser', baseline * 1000))
+
+    for backend in ('html.parser', 'lxml'):
+        twoot.TOML['options']['html_parser'] = backend
+        try:
+            results = [extract(restricted_main_tweet(page)) for page in pages]
+        except FeatureNotFound:
+            print('{:<28} {:>10}'.format('main tweet, ' + backend, 'not installed'))
+            continue
+
+        if results != reference:
+            print('ERROR: extraction with ' + backend + ' differs from full page parsing')
+            sys.exit(1)
+
+        elapsed = time_strategy(restricted_main_tweet, pages, args['n'])
+        print('{:<28} {:>10.3f} ms/page  x{:.1f}'.format('main tweet, ' + backend, elapsed * 1000,
+                                                         baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
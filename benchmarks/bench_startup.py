@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Startup benchmark of twoot
+
+    Measures with python -X importtime the time needed to import twoot and the
+    run time of a JSON export of one status (-t ... -j ...) served by a local
+    nitter stub. Checks that the modules that twoot only needs on some code
+    paths (Mastodon.py, the process pool, the TOML and XML parsers), and
+    asyncio, are not loaded by the import or by the export.
+
+    The benchmark fails (exit code 1) if such a module is loaded, if the median
+    import time exceeds the budget given with -b, or, with -c, if it regressed
+    by more than -t percent compared to a saved report:
+        bench_startup.py -o before.json
+        bench_startup.py -c before.json
+
+    Usage: bench_startup.py [-s <twoot.py>] [-C <corpus dir>] [-n <runs>] [-b <budget ms>]
+                            [-o <report.json>] [-c <report.json>] [-t <percent>]
+"""
+
+import argparse
+import json
+import os
+import py_compile
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from bench_e2e import percentile, revision
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+# Modules that must only be imported on the code paths that use them
+LAZY_MODULES = ['mastodon', 'asyncio', 'multiprocessing', 'concurrent.futures.process',
+                'tomllib', 'tomli', 'xml.etree.ElementTree']
+
+# import time:  <self us> | <cumulative us> | <indentation><module>
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+IMPORT_CODE = '''
+import sys
+sys.path.insert(0, {directory!r})
+import twoot
+'''
+
+EXPORT_CODE = '''
+import sys
+sys.path.insert(0, {directory!r})
+import twoot
+twoot.NITTER_URLS[:] = [{nitter!r}]
+sys.argv = ['twoot.py', '-t', {status!r}, '-j', 'tweet.json']
+twoot.main(sys.argv)
+'''
+
+
+class NitterHandler(BaseHTTPRequestHandler):
+    """
+    Serve the page of the server for any status and nothing else
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if '/status/' in self.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(self.server.page)))
+            self.end_headers()
+            self.wfile.write(self.server.page)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: output of python -X importtime
+    :return: tuple (dictionary of cumulative import time in ms by module, list of
+             (module, cumulative ms) imported directly by twoot)
+    """
+    modules = {}
+    children = []
+    direct = []
+    for line in stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m is None:
+            continue
+        name = m.group(4)
+        cumulative = int(m.group(2)) / 1000
+        modules[name] = cumulative
+        depth = len(m.group(3)) // 2
+        if depth == 0:
+            if name == 'twoot':
+                direct = children
+            children = []
+        elif depth == 1:
+            children.append((name, cumulative))
+
+    return modules, direct
+
+
+def run_python(code, cwd):
+    """
+    Run python code in a fresh interpreter with -X importtime
+    :param code: code to run
+    :param cwd: working directory
+    :return: tuple (exit code, wall time in ms, output of -X importtime)
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd,
+                            capture_output=True, text=True)
+    return result.returncode, (time.perf_counter() - start) * 1000, result.stderr
+
+
+def compare(report, baseline):
+    """
+    Print the change of each measure between a baseline report and this report
+    :param report: report of this benchmark
+    :param baseline: report loaded from file
+    """
+    print()
+    print('{:<28} {:>10} {:>10}'.format('compared to ' + str(baseline.get('revision')), 'before', 'after'))
+    for name in ('import_ms', 'import_p95_ms', 'export_ms'):
+        before, after = baseline[name], report[name]
+        print('{:<28} {:>10.1f} {:>10.1f} {:<4} {:>+7.1f}%'.format(name, before, after, 'ms',
+                                                                  (after - before) / before * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark startup time of twoot.')
+    parser.add_argument('-s', metavar='<twoot.py>', action='store', default=str(BENCH_DIR.parent / 'twoot.py'))
+    parser.add_argument('-C', metavar='<corpus dir>', action='store', default=str(BENCH_DIR / 'corpus'))
+    parser.add_argument('-n', metavar='<runs>', type=int, action='store', default=15)
+    parser.add_argument('-b', metavar='<budget ms>', type=float, action='store', default=250,
+                        help='Maximum median import time')
+    parser.add_argument('-o', metavar='<report.json>', action='store', help='Save report')
+    parser.add_argument('-c', metavar='<report.json>', action='store', help='Compare with saved report')
+    parser.add_argument('-t', metavar='<percent>', type=float, action='store', default=15,
+                        help='Maximum regression of median import time compared to -c report')
+    args = vars(parser.parse_args())
+
+    source = Path(args['s']).resolve()
+    pages = sorted(Path(args['C']).glob('*_*.html'))
+    if not pages:
+        print('No <author>_<status id>.html page found in ' + args['C'])
+        sys.exit(1)
+    author, status_id = pages[0].stem.rsplit('_', 1)
+
+    # Measure startup with the bytecode cached, as after the first run of an installed twoot
+    py_compile.compile(str(source), doraise=True)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NitterHandler)
+    server.page = pages[0].read_bytes()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    nitter = 'http://127.0.0.1:' + str(server.server_address[1])
+
+    import_code = IMPORT_CODE.format(directory=str(source.parent))
+    export_code = EXPORT_CODE.format(directory=str(source.parent), nitter=nitter,
+                                     status='https://x.com/' + author + '/status/' + status_id)
+
+    import_times = []
+    export_times = []
+    loaded = {'import': set(), 'export': set()}
+    heaviest = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        # Warm up file system caches
+        run_python(import_code, workdir)
+
+        for run in range(args['n']):
+            code, wall, stderr = run_python(import_code, workdir)
+            modules, direct = parse_importtime(stderr)
+            if code != 0 or 'twoot' not in modules:
+                print('ERROR: import of twoot failed')
+                print(stderr[-2000:])
+                sys.exit(1)
+            import_times.append(modules['twoot'])
+            loaded['import'].update(m for m in LAZY_MODULES if m in modules)
+            for name, ms in direct:
+                heaviest.setdefault(name, []).append(ms)
+
+            # Each export starts without database, as a first run would
+            rundir = os.path.join(workdir, str(run))
+            os.mkdir(rundir)
+            code, wall, stderr = run_python(export_code, rundir)
+            if code != 0 or not os.path.isfile(os.path.join(rundir, 'tweet.json')):
+                print('ERROR: export of status failed (exit code ' + str(code) + ')')
+                print(stderr[-2000:])
+                sys.exit(1)
+            export_times.append(wall)
+            loaded['export'].update(m for m in LAZY_MODULES if m in parse_importtime(stderr)[0])
+
+    server.shutdown()
+
+    report = {
+        'revision': revision(str(source)),
+        'python': sys.version.split()[0],
+        'runs': args['n'],
+        'import_ms': statistics.median(import_times),
+        'import_p95_ms': percentile(import_times, 0.95),
+        'export_ms': statistics.median(export_times),
+        'heaviest_imports': dict(sorted(((name, statistics.median(ms)) for name, ms in heaviest.items()),
+                                        key=lambda item: -item[1])[:10]),
+        'lazy_modules_loaded': {path: sorted(modules) for path, modules in loaded.items()},
+    }
+
+    print('{:<28} {:>10.1f} ms (p95 {:.1f} ms, budget {:.0f} ms)'.format('import twoot', report['import_ms'],
+                                                                         report['import_p95_ms'], args['b']))
+    print('{:<28} {:>10.1f} ms'.format('export of one status', report['export_ms']))
+    print()
+    print('{:<28} {:>10}'.format('heaviest imports of twoot', 'ms'))
+    for name, ms in report['heaviest_imports'].items():
+        print('{:<28} {:>10.1f}'.format(name, ms))
+
+    if args['o'] is not None:
+        with open(args['o'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if args['c'] is not None:
+        with open(args['c']) as f:
+            baseline = json.load(f)
+        compare(report, baseline)
+        if report['import_ms'] > baseline['import_ms'] * (1 + args['t'] / 100):
+            print('FAILED: import time regressed by more than ' + str(args['t']) + '%')
+            failed = True
+
+    print()
+    for path, modules in report['lazy_modules_loaded'].items():
+        if modules:
+            print('FAILED: ' + ', '.join(modules) + ' loaded by ' + path)
+            failed = True
+    if report['import_ms'] > args['b']:
+        print('FAILED: import time over budget of ' + str(args['b']) + ' ms')
+        failed = True
+    if not failed:
+        print('OK')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,31 +20,131 @@
 
 import argparse
 import codecs
-from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager, ExitStack
+from datetime import date, datetime
+import hashlib
 import logging
+import math
 import os
 import shutil
 import random
 import re
 import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 from pathlib import Path
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, urljoin
 
 import requests
-from bs4 import BeautifulSoup, element
-from mastodon import Mastodon, MastodonError, MastodonAPIError, MastodonIllegalArgumentError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer, element
 from base64 import b64encode
 
 USE_AUTH = False # Support basic HTTP auth
 
 # Number of records to keep in db table for each twitter account
+# Default value of the max_records option
 MAX_REC_COUNT = 50
 
 # How many seconds to wait before giving up on a download (except video download)
 HTTPS_REQ_TIMEOUT = 10
 
+# Local database used to persist state between runs
+DB_FILE = 'twoot.db'
+
+# Database files whose tables were created by this process
+DB_SCHEMA_READY = set()
+DB_SCHEMA_LOCK = threading.Lock()
+
+# Statistics on nitter instances lose half of their weight after this many seconds
+NITTER_HEALTH_HALF_LIFE = 6 * 3600
+
+# Maximum number of nitter instances to try before giving up on a page
+NITTER_MAX_ATTEMPTS = 3
+
+# Duration of each stage of processing and counters for this process. See write_metrics()
+METRICS = {'stages': {}, 'counters': {}}
+METRICS_LOCK = threading.Lock()
+
+# Number of hosts and of connections per host kept alive by the HTTP client
+HTTP_POOL_HOSTS = 20
+HTTP_POOL_SIZE = 10
+
+# Number of times a failed idempotent request is retried with exponential backoff
+HTTP_RETRIES = 2
+
+# Cookies sent to nitter instances to get original links and direct video urls
+NITTER_COOKIES = 'replaceTwitter=; replaceYouTube=; hlsPlayback=on; proxyVideos='
+
+# Start of each item of a nitter timeline and link to the status of the item. Used to
+# find new statuses in the raw page of the timeline without parsing it
+TIMELINE_ITEM_RE = re.compile(r'<div class="timeline-item[ "]')
+TWEET_LINK_RE = re.compile(r'class="tweet-link" href="/([^/"]+)/status/(\d+)')
+
+# Author and status id in the link of an item of the RSS feed of a nitter timeline
+RSS_LINK_RE = re.compile(r'/([^/]+)/status/(\d+)')
+RSS_CREATOR_TAG = '{http://purl.org/dc/elements/1.1/}creator'
+# Thumbnails of the media that the RSS feed only shows as a picture
+RSS_VIDEO_THUMBS = ('video_thumb', 'amplify_video')
+
+# Size of the chunks in which media are downloaded and uploaded
+MEDIA_CHUNK_SIZE = 16 * 1024
+
+# Directory of the pictures of the media cache, named after the digest of their content
+MEDIA_CACHE_DIR = 'media_cache'
+
+# Number of seconds an uploaded picture can be reused for. Mastodon deletes the media
+# that are not attached to a status after a day
+MEDIA_ID_TTL = 20 * 3600
+
+# Directory where videos made conformant to the instance limits are cached
+CONFORM_CACHE_DIR = os.path.join('cache', 'conform')
+
+# Number of days a conformed video is kept in cache after it was last used
+CONFORM_CACHE_DAYS = 7
+
+# Worker processes transcoding videos, started by conform_pool() when first needed
+CONFORM_POOL = None
+CONFORM_POOL_LOCK = threading.Lock()
+
+# Number of seconds the capabilities of a Mastodon instance are cached for
+CAPABILITIES_TTL = 24 * 3600
+
+# Limits of a Mastodon instance that does not publish its configuration
+DEFAULT_CAPABILITIES = {
+    'max_characters': 500,
+    'max_media_attachments': 4,
+    'characters_reserved_per_url': 23,
+    'supported_mime_types': None,
+    'image_size_limit': 10 * 1024 * 1024,
+    'image_matrix_limit': 16777216,
+    'video_size_limit': 40 * 1024 * 1024,
+    'video_matrix_limit': 2304000,
+}
+
+# Text that is too long is cut after the last word if it ends less than this number
+# of characters before the limit, and at the limit otherwise
+TRIM_MAX_WORD_LENGTH = 30
+
+# Capabilities of Mastodon instances loaded by this process
+INSTANCE_CAPABILITIES = {}
+INSTANCE_CAPABILITIES_LOCK = threading.Lock()
+
+# Semaphores limiting concurrent media transfers to each host, shared by all jobs
+HOST_SLOTS = {}
+HOST_SLOTS_LOCK = threading.Lock()
+
+# Locks of the tweets being mirrored by the jobs in progress, with the number of jobs waiting for them
+STATUS_LOCKS = {}
+STATUS_LOCKS_LOCK = threading.Lock()
+
 NITTER_URLS = [
     'https://nitter.lacontrevoie.fr',  # rate limited
     #    'https://twitter.femboy.hu',  # 404 on 06/05/2023
@@ -60,6 +160,35 @@ NITTER_URLS = [
     #    'https://nitter.privacydev.net', # USA, added 06/02/2023, removed 15/02/2023 too slow
 ]
 
+# Parameters removed from URLs by clean_url(). '*' matches any sequence of characters
+# Avalaible URL tracking parameters :
+# UTM tags by Google Ads, M$ Ads, ...
+# tag by TikTok
+# tags by Snapchat
+# tags by Facebook
+TRACKER_RULES_DEFAULT = {
+    'query': [
+        "gclid", "_ga", "gclsrc", "dclid",
+        "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "utm_cid",
+        "utm_reader", "utm_name", "utm_referrer", "utm_social", "utm_social-type", "utm_brand",
+        "mkt_tok",
+        "campaign_name", "ad_set_name", "campaign_id", "ad_set_id",
+        "fbclid", "media", "interest_group_name",
+        "igshid",
+        "cvid", "oicd", "msclkid",
+        "soc_src", "soc_trk",
+        "_openstat", "yclid",
+        "xtor", "xtref", "adid",
+    ],
+    'fragment': [
+        "Echobox",
+    ],
+    'domains': {},
+}
+
+# Tracker rules compiled from TRACKER_RULES_DEFAULT and the rule files
+TRACKER_RULES = None
+
 # Update from https://www.whatismybrowser.com/guides/the-latest-user-agent/
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
@@ -96,11 +225,33 @@ def build_config(args):
         'subst_reddit': [],
         'log_level': "INFO",
         'log_days': 3,
-        'export_json_path': ''
+        'export_json_path': '',
+        'media_workers': 4,
+        'media_per_host': 2,
+        'stream_media': False,
+        'media_spool_threshold': 8 * 1024 * 1024,
+        'url_cache_days': 7,
+        'url_cache_max_entries': 10000,
+        'html_parser': 'html.parser',
+        'max_records': MAX_REC_COUNT,
+        'max_concurrent_jobs': 4,
+        'media_processing_timeout': 120,
+        'video_max_bytes': 40 * 1024 * 1024,
+        'video_max_pixels': 1920 * 1200,
+        'tracker_rules_files': [],
+        'metrics_json_path': '',
+        'metrics_prom_path': '',
+        'page_cache_days': 2,
+        'page_cache_fresh_minutes': 30,
+        'mirror_thread': False,
+        'timeline_max_statuses': 20,
+        'timeline_source': 'html',
+        'media_cache_max_mb': 100,
+        'media_cache_days': 7,
     }
 
     # Create default config object
-    TOML = {'config': {}, 'options': options}
+    TOML = {'config': {}, 'options': options, 'destinations': []}
 
     # Load config file if it was provided
     toml_file = args['f']
@@ -124,6 +275,7 @@ def build_config(args):
             terminate(-1)
 
         TOML['config'] = loaded_toml['config']
+        TOML['destinations'] = loaded_toml.get('destinations', [])
         for k in TOML['options'].keys():
             try:  # Go through all valid keys
                 TOML['options'][k] = loaded_toml['options'][k]
@@ -133,6 +285,8 @@ def build_config(args):
         # Override config parameters with command-line values provided
         if args['t'] is not None:
             TOML['config']['twitter_status'] = args['t']
+        if args['a'] is not None:
+            TOML['config']['twitter_account'] = args['a']
         if args['i'] is not None:
             TOML['config']['mastodon_instance'] = args['i']
         if args['m'] is not None:
@@ -145,26 +299,60 @@ def build_config(args):
             TOML['options']['remove_trackers_from_urls'] = args['u']
         if args['o'] is True:
             TOML['options']['remove_original_tweet_ref'] = args['o']
+        if args['r'] is True:
+            TOML['options']['mirror_thread'] = args['r']
         if args['j'] is not None:
             TOML['options']['export_json_path'] = args['j']
 
+    # Compile tracker rules once for all URLs
+    global TRACKER_RULES
+    try:
+        TRACKER_RULES = compile_tracker_rules(TOML['options']['tracker_rules_files'])
+    except (OSError, ValueError) as e:
+        print('CRITICAL: Could not load tracker rules: ' + str(e))
+        terminate(-1)
+
+    # Fall back to the parser included in python if the configured one is not installed
+    if TOML['options']['html_parser'] != 'html.parser':
+        try:
+            BeautifulSoup('', TOML['options']['html_parser'])
+        except FeatureNotFound:
+            print('WARNING: HTML parser ' + TOML['options']['html_parser'] + ' not available. Using html.parser')
+            TOML['options']['html_parser'] = 'html.parser'
+
+    if TOML['options']['timeline_source'] not in ('html', 'rss'):
+        print('CRITICAL: timeline_source must be "html" or "rss"')
+        terminate(-1)
+
     # Verify that we have a minimum config to run
-    if 'twitter_status' not in TOML['config'].keys() or TOML['config']['twitter_status'] == "":
-        print('CRITICAL: Missing Twitter  post')
+    if args['b'] is None and args['d'] is None and TOML['config'].get('twitter_status', '') == "" \
+            and TOML['config'].get('twitter_account', '') == "":
+        print('CRITICAL: Missing Twitter  post or account')
         terminate(-1)
 
-    if 'export_json_path' not in TOML['options'].keys():
-        if 'mastodon_instance' not in TOML['config'].keys() or TOML['config']['mastodon_instance'] == "":
-            print('CRITICAL: Missing Mastodon instance')
-            terminate(-1)
-        if 'mastodon_user' not in TOML['config'].keys() or TOML['config']['mastodon_user'] == "":
+    # Without [[destinations]], statuses are posted on the account of the [config] section
+    if not TOML['destinations'] and TOML['config'].get('mastodon_instance', '') != '' \
+            and TOML['config'].get('mastodon_user', '') != '':
+        TOML['destinations'] = [{'mastodon_instance': TOML['config']['mastodon_instance'],
+                                 'mastodon_user': TOML['config']['mastodon_user']}]
+
+    if TOML['options']['export_json_path'] == '':
+        if not TOML['destinations']:
+            if TOML['config'].get('mastodon_instance', '') == "":
+                print('CRITICAL: Missing Mastodon instance')
+                terminate(-1)
             print('CRITICAL: Missing Mastodon user')
             terminate(-1)
+        for destination in TOML['destinations']:
+            if destination.get('mastodon_instance', '') == "" or destination.get('mastodon_user', '') == "":
+                print('CRITICAL: Missing Mastodon instance or user in [[destinations]]')
+                terminate(-1)
 
 
-def deredir_url(url):
+def deredir_url(session, url):
     """
     Given a URL, return the URL that the page really downloads from
+    :param session: HTTP client returned by build_session()
     :param url: url to be de-redirected
     :return: direct url
     """
@@ -172,21 +360,16 @@ def deredir_url(url):
     if TOML['options']['remove_link_redirections'] is False:
         return url
 
-    # Get a copy of the default headers that requests would use
-    headers = requests.utils.default_headers()
-
-    # Update default headers with randomly selected user agent
-    headers.update(
-        {
-            'User-Agent': USER_AGENTS[random.randint(0, len(USER_AGENTS) - 1)],
-        }
-    )
+    # Check if the redirection was already resolved
+    cached = url_cache_get(url, 'redirect')
+    if cached is not None:
+        return cached
 
     ret = None
     try:
         # Download the page
-        ret = requests.head(url, headers=headers,
-                            allow_redirects=True, timeout=5)
+        with timed_stage('deredir'):
+            ret = session.head(url, allow_redirects=True, timeout=5)
     except:
         # If anything goes wrong keep the URL intact
         return url
@@ -194,38 +377,116 @@ def deredir_url(url):
     if ret.url != url:
         logging.debug("Removed redirection from: " + url + " to: " + ret.url)
 
+    url_cache_put(url, 'redirect', ret.url)
+
     # Return the URL that the page was downloaded from
     return ret.url
 
 
-def _remove_trackers_query(query_str):
+def compile_tracker_rules(rule_files):
+    """
+    Compile the rules used to remove trackers from URLs
+    Rules are parameter names in which '*' matches any sequence of characters.
+    They apply to all domains or to a domain and its subdomains. Rule files are
+    TOML files with the same structure as TRACKER_RULES_DEFAULT:
+        query = ["utm_*", ...]        # query parameters removed on all domains
+        fragment = ["Echobox", ...]   # fragment parameters removed on all domains
+        [domains]
+        "amazon.com" = ["ref", "pd_rd_*"]
+    :param rule_files: list of paths of rule files loaded in addition to the default rules
+    :return: dictionary of compiled rules. Each rule is a tuple (set of names, pattern of the
+             names with '*' or None)
+    :raise OSError, ValueError: if a rule file cannot be loaded
+    """
+    query = list(TRACKER_RULES_DEFAULT['query'])
+    fragment = list(TRACKER_RULES_DEFAULT['fragment'])
+    domains = {}
+    for domain, params in TRACKER_RULES_DEFAULT['domains'].items():
+        domains.setdefault(domain, []).extend(params)
+
+    if rule_files:
+        try:  # Included in python from version 3.11
+            import tomllib
+        except ModuleNotFoundError:
+            # for python < 3.11, tomli module must be installed
+            import tomli as tomllib
+
+        for rule_file in rule_files:
+            with open(rule_file, 'rb') as f:
+                rules = tomllib.load(f)
+            query.extend(rules.get('query', []))
+            fragment.extend(rules.get('fragment', []))
+            for domain, params in rules.get('domains', {}).items():
+                domains.setdefault(domain.lower(), []).extend(params)
+
+    def compile_patterns(patterns):
+        # Plain names are looked up in a set. Names with '*' are merged into one alternation
+        # matched against whole parameter names
+        wildcards = sorted({p for p in patterns if '*' in p})
+        return (frozenset(p for p in patterns if '*' not in p),
+                re.compile('|'.join(re.escape(p).replace('\\*', '.*') for p in wildcards)) if wildcards else None)
+
+    return {
+        'query': compile_patterns(query),
+        # Trackers are also found in fragments (e.g. #mkt_tok=...)
+        'fragment': compile_patterns(query + fragment),
+        'domains': {domain: compile_patterns(params) for domain, params in domains.items()},
+    }
+
+
+def _is_tracker(name, rule):
+    """
+    private function
+    :param name: name of a query or fragment parameter
+    :param rule: compiled rule returned by compile_tracker_rules()
+    :return: True if the parameter is removed by the rule
+    """
+    names, pattern = rule
+    return name in names or (pattern is not None and pattern.fullmatch(name) is not None)
+
+
+def _domain_rules(netloc):
+    """
+    private function
+    :param netloc: network location of a URL
+    :return: compiled rules of the domain and its parent domains. None if there are none
+    """
+    host = netloc.rsplit('@', 1)[-1].split(':', 1)[0].lower()
+    patterns = []
+    while host != '':
+        rule = TRACKER_RULES['domains'].get(host)
+        if rule is not None:
+            patterns.append(rule)
+        host = host.partition('.')[2]
+
+    return patterns or None
+
+
+def _remove_trackers_query(query_str, domain_rules=None):
     """
     private function
     Given a query string from a URL, strip out the known trackers
     :param query_str: query to be cleaned
-    :return: query cleaned
-    """
-    # Avalaible URL tracking parameters :
-    # UTM tags by Google Ads, M$ Ads, ...
-    # tag by TikTok
-    # tags by Snapchat
-    # tags by Facebook
-    params_to_remove = {
-        "gclid", "_ga", "gclsrc", "dclid",
-        "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "utm_cid",
-        "utm_reader", "utm_name", "utm_referrer", "utm_social", "utm_social-type", "utm_brand"
-        "mkt_tok",
-        "campaign_name", "ad_set_name", "campaign_id", "ad_set_id",
-        "fbclid", "campaign_name", "ad_set_name", "ad_set_id", "media", "interest_group_name", "ad_set_id"
-        "igshid",
-        "cvid", "oicd", "msclkid",
-        "soc_src", "soc_trk",
-        "_openstat", "yclid",
-        "xtor", "xtref", "adid",
-    }
+    :param domain_rules: compiled rules applying to the domain of the URL
+    :return: query cleaned. Unchanged if it does not contain trackers
+    """
+    def is_tracker(k):
+        if _is_tracker(k, TRACKER_RULES['query']):
+            return True
+        return domain_rules is not None and any(_is_tracker(k, r) for r in domain_rules)
+
+    # Fast path: plain parameter names can be checked without decoding the query
+    if '%' not in query_str and '+' not in query_str:
+        keys = [param.partition('=')[0] for param in query_str.split('&')]
+        if all(keys) and len(set(keys)) == len(keys) and not any(is_tracker(k) for k in keys):
+            return query_str
+
     query_to_clean = dict(parse_qsl(query_str, keep_blank_values=True))
-    query_cleaned = [(k, v) for k, v in query_to_clean.items()
-                     if k not in params_to_remove]
+    query_cleaned = [(k, v) for k, v in query_to_clean.items() if not is_tracker(k)]
+    if len(query_cleaned) == len(query_to_clean) and len(query_to_clean) == query_str.count('&') + 1:
+        # Nothing removed: keep the original encoding of the query
+        return query_str
+
     return urlencode(query_cleaned, doseq=True)
 
 
@@ -236,14 +497,10 @@ def _remove_trackers_fragment(fragment_str):
     :param query_str: fragment to be cleaned
     :return: cleaned fragment
     """
-    params_to_remove = {
-        "Echobox",
-    }
-
     if '=' in fragment_str:
         fragment_str = fragment_str.split('&')
-        query_cleaned = [i for i in fragment_str if i.split(
-            '=')[0] not in params_to_remove]
+        query_cleaned = [i for i in fragment_str
+                         if not _is_tracker(i.split('=')[0], TRACKER_RULES['fragment'])]
         fragment_str = '&'.join(query_cleaned)
     return fragment_str
 
@@ -303,18 +560,31 @@ def clean_url(orig_url):
     if TOML['options']['remove_trackers_from_urls'] is False:
         return orig_url
 
+    global TRACKER_RULES
+    if TRACKER_RULES is None:
+        TRACKER_RULES = compile_tracker_rules(TOML['options'].get('tracker_rules_files', []))
+
     # Parse a URL into 6 components:
     # <scheme>://<netloc>/<path>;<params>?<query>#<fragment>
     url_parsed = urlparse(orig_url)
 
+    # Nothing to remove if there is no query nor fragment
+    if url_parsed.query == '' and url_parsed.fragment == '':
+        return orig_url
+
+    query = _remove_trackers_query(url_parsed.query, _domain_rules(url_parsed.netloc))
+    fragment = _remove_trackers_fragment(url_parsed.fragment)
+    if query == url_parsed.query and fragment == url_parsed.fragment:
+        return orig_url
+
     # Reassemble URL after removal of trackers
     dest_url = urlunparse([
         url_parsed.scheme,
         url_parsed.netloc,
         url_parsed.path,
         url_parsed.params,
-        _remove_trackers_query(url_parsed.query),
-        _remove_trackers_fragment(url_parsed.fragment)
+        query,
+        fragment
     ])
     if dest_url != orig_url:
         logging.debug('Cleaned URL from: ' + orig_url + ' to: ' + dest_url)
@@ -322,10 +592,30 @@ def clean_url(orig_url):
     return dest_url
 
 
-def process_media_body(tt_iter):
+def clean_urls(urls):
+    """
+    Remove the trackers from many URLs at once
+    URLs that appear several times are only cleaned once
+    :param urls: iterable of urls
+    :return: list of cleaned urls, in the same order
+    """
+    cleaned = {}
+    result = []
+    for url in urls:
+        dest_url = cleaned.get(url)
+        if dest_url is None:
+            dest_url = clean_url(url)
+            cleaned[url] = dest_url
+        result.append(dest_url)
+
+    return result
+
+
+def process_media_body(session, tt_iter):
     """
     Receives an iterator over all the elements contained in the tweet-text container.
     Processes them to make them suitable for posting on Mastodon
+    :param session: HTTP client returned by build_session()
     :param tt_iter: iterator over the HTML elements in the text of the tweet
     :return:        cleaned up text of the tweet
     """
@@ -348,7 +638,7 @@ def process_media_body(tt_iter):
                 tweet_text += tag_text
             else:
                 # This is a real link
-                url = deredir_url(tag.get('href'))
+                url = deredir_url(session, tag.get('href'))
                 url = substitute_source(url)
                 url = clean_url(url)
 
@@ -360,6 +650,122 @@ def process_media_body(tt_iter):
     return tweet_text
 
 
+@contextmanager
+def host_slot(*urls):
+    """
+    Wait for a free transfer slot on the hosts of the given URLs
+    At most media_per_host transfers run concurrently on the same host.
+    Slots are always acquired in the same order to avoid deadlocks between jobs
+    :param urls: urls of the resources being transferred
+    """
+    with ExitStack() as stack:
+        for host in sorted({urlparse(url).netloc for url in urls}):
+            with HOST_SLOTS_LOCK:
+                slot = HOST_SLOTS.get(host)
+                if slot is None:
+                    slot = threading.BoundedSemaphore(TOML['options']['media_per_host'])
+                    HOST_SLOTS[host] = slot
+            stack.enter_context(slot)
+
+        yield
+
+
+def _status_key(status_id):
+    """
+    private function
+    :param status_id: id of tweet
+    :return: sort key giving the numeric order of tweet ids, i.e. their chronological order
+    """
+    return len(status_id), status_id
+
+
+@contextmanager
+def status_lock(*status_ids):
+    """
+    Wait until no other job is mirroring the given tweets
+    Jobs of the same tweet would both post it and remove the files the other is uploading.
+    Locks are always acquired in the same order to avoid deadlocks between jobs
+    :param status_ids: ids of the tweets mirrored
+    """
+    status_ids = sorted(set(status_ids), key=_status_key)
+    locks = []
+    with STATUS_LOCKS_LOCK:
+        for status_id in status_ids:
+            entry = STATUS_LOCKS.setdefault(status_id, [threading.Lock(), 0])
+            entry[1] += 1
+            locks.append(entry[0])
+
+    try:
+        with ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+
+            yield
+
+    finally:
+        with STATUS_LOCKS_LOCK:
+            for status_id in status_ids:
+                STATUS_LOCKS[status_id][1] -= 1
+                if STATUS_LOCKS[status_id][1] == 0:
+                    del STATUS_LOCKS[status_id]
+
+
+def record_stage(stage, seconds):
+    """
+    Add the duration of one execution of a stage to the metrics
+    :param stage: name of stage
+    :param seconds: duration of execution
+    """
+    with METRICS_LOCK:
+        stats = METRICS['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    Measure the duration of a stage of processing, whether it succeeds or not
+    Concurrent jobs add up so the total of a stage can exceed the run time
+    :param stage: name of stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def count_metric(counter, value=1):
+    """
+    Increment a counter of the metrics
+    :param counter: name of counter
+    :param value: amount to add
+    """
+    with METRICS_LOCK:
+        METRICS['counters'][counter] = METRICS['counters'].get(counter, 0) + value
+
+
+def download_to_file(session, url, file_path):
+    """
+    Download a resource to a file in chunks
+    :param session: HTTP client returned by build_session()
+    :param url: url of the resource
+    :param file_path: path of the file to write
+    :raise requests.exceptions.RequestException: if the download failed
+    """
+    with host_slot(url), timed_stage('media_download'), \
+            session.get(url, stream=True, timeout=HTTPS_REQ_TIMEOUT) as r:
+        # Raise exception if response code is not 200
+        r.raise_for_status()
+        # Download chunks and write them to file
+        with open(file_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                f.write(chunk)
+                count_metric('bytes_downloaded', len(chunk))
+
+
 def process_card(nitter_url, card_container):
     """
     Extract image from card in case mastodon does not do it
@@ -377,9 +783,10 @@ def process_card(nitter_url, card_container):
     return list
 
 
-def process_attachments(nitter_url, attachments_container, status_id, author_account):
+def process_attachments(session, nitter_url, attachments_container, status_id, author_account):
     """
     Extract images or video from attachments. Videos are downloaded on the file system.
+    :param session: HTTP client returned by build_session()
     :param nitter_url: url of nitter mirror
     :param attachments_container: soup of 'div' tag containing attachments markup
     :param twit_account: name of twitter account
@@ -404,27 +811,16 @@ def process_attachments(nitter_url, attachments_container, status_id, author_acc
             'output', status_id, author_account, status_id)
         os.makedirs(video_path, exist_ok=True)
 
-        # Open directory for writing file
-        orig_dir = os.getcwd()
-        os.chdir(video_path)
-        with requests.get(gif_video_file, stream=True, timeout=HTTPS_REQ_TIMEOUT) as r:
-            try:
-                # Raise exception if response code is not 200
-                r.raise_for_status()
-                # Download chunks and write them to file
-                with open('gif_video.mp4', 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=16 * 1024):
-                        f.write(chunk)
-
-                logging.debug(
-                    'Downloaded video of GIF animation from attachments')
-            except:  # Don't do anything if video can't be found or downloaded
-                logging.debug(
-                    'Could not download video of GIF animation from attachments')
-                pass
-
-        # Close directory
-        os.chdir(orig_dir)
+        # Write file directly in its directory. Changing the working directory
+        # would affect other jobs running concurrently in daemon mode
+        try:
+            download_to_file(session, gif_video_file, os.path.join(video_path, 'gif_video.mp4'))
+            logging.debug(
+                'Downloaded video of GIF animation from attachments')
+        except:  # Don't do anything if video can't be found or downloaded
+            logging.debug(
+                'Could not download video of GIF animation from attachments')
+            pass
 
     # Download twitter video
     vid_in_tweet = False
@@ -438,26 +834,18 @@ def process_attachments(nitter_url, attachments_container, status_id, author_acc
                 os.makedirs(out_video, exist_ok=True)
                 vid_in_tweet = True
 
-            i = 0
-            for video in videos:
-                video_url = video.find('source').get('src')
-                video_out_path = out_video + "/" + str(i) + ".mp4"
-
-                with requests.get(video_url, stream=True, timeout=HTTPS_REQ_TIMEOUT) as r:
-                    try:
-                        # Raise exception if response code is not 200
-                        r.raise_for_status()
-                        # Download chunks and write them to file
-                        with open(video_out_path, 'wb') as f:
-                            for chunk in r.iter_content(chunk_size=16 * 1024):
-                                f.write(chunk)
+            video_urls = [video.find('source').get('src') for video in videos]
+            video_out_paths = [out_video + "/" + str(i) + ".mp4" for i in range(len(videos))]
 
+            # Download all the videos concurrently
+            with ThreadPoolExecutor(max_workers=TOML['options']['media_workers']) as pool:
+                try:
+                    for _ in pool.map(lambda url, path: download_to_file(session, url, path),
+                                      video_urls, video_out_paths):
                         logging.debug('Downloaded video from attachments')
-                    except:  # Don't do anything if video can't be found or downloaded
-                        logging.error('Could not download video from attachments')
-                        exit(0)
-
-                i += 1
+                except:  # Video can't be found or downloaded
+                    logging.error('Could not download video from attachments')
+                    raise
 
     return pics, vid_in_tweet
 
@@ -476,26 +864,49 @@ def contains_class(body_classes, some_class):
     return found
 
 
-def login(password):
+def token_file(destination):
+    """
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    :return: path of the file holding the access token of the account, <instance>.<user>.secret.
+             With a single destination, <user>.secret written by earlier versions if it is the
+             only one that exists
+    """
+    path = destination['mastodon_instance'] + '.' + destination['mastodon_user'] + '.secret'
+    legacy_path = destination['mastodon_user'] + '.secret'
+    if not os.path.isfile(path) and len(TOML.get('destinations', [])) <= 1 and os.path.isfile(legacy_path):
+        return legacy_path
+    return path
+
+
+def login(session, password, destination):
     """
     Login to Mastodon account and return mastodon object used to post content
+    :param session: HTTP client returned by build_session(). Also used by the mastodon object
     :param password: Password associated to account. None if not provided
-    :return: mastodon object
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    :return: mastodon object. None if login failed
     """
+    from mastodon import Mastodon, MastodonError
+
+    instance = destination['mastodon_instance']
+    user = destination['mastodon_user']
+    # The same user name (e-mail address) can have accounts on several instances
+    user_secret = instance + '.' + user + '.secret'
+
 # Create Mastodon application if it does not exist yet
-    if not os.path.isfile(TOML['config']['mastodon_instance'] + '.secret'):
+    if not os.path.isfile(instance + '.secret'):
         try:
             Mastodon.create_app(
                 'feedtoot',
-                api_base_url='https://' + TOML['config']['mastodon_instance'],
-                to_file=TOML['config']['mastodon_instance'] + '.secret'
+                api_base_url='https://' + instance,
+                to_file=instance + '.secret',
+                session=session
             )
 
         except MastodonError as me:
-            logging.fatal('failed to create app on ' +
-                          TOML['config']['mastodon_instance'])
-            logging.fatal(me)
-            terminate(-1)
+            logging.error('failed to create app on ' + instance)
+            logging.error(me)
+            return None
 
     mastodon = None
 
@@ -503,504 +914,2867 @@ def login(password):
     if password is not None:
         try:
             mastodon = Mastodon(
-                client_id=TOML['config']['mastodon_instance'] + '.secret',
-                api_base_url='https://' + TOML['config']['mastodon_instance']
+                client_id=instance + '.secret',
+                api_base_url='https://' + instance,
+                session=session
             )
 
             mastodon.log_in(
-                username=TOML['config']['mastodon_user'],
+                username=user,
                 password=password,
-                to_file=TOML['config']['mastodon_user'] + ".secret"
+                to_file=user_secret
             )
-            logging.info('Logging in to ' +
-                         TOML['config']['mastodon_instance'])
+            logging.info('Logging in to ' + instance)
 
         except MastodonError as me:
-            logging.fatal(
-                'Login to ' + TOML['config']['mastodon_instance'] + ' Failed\n')
-            logging.fatal(me)
-            terminate(-1)
+            logging.error('Login to ' + instance + ' Failed\n')
+            logging.error(me)
+            return None
 
-        if os.path.isfile(TOML['config']['mastodon_user'] + '.secret'):
+        if os.path.isfile(user_secret):
             logging.warning('You successfully logged in using a password and an access token \
                             has been saved. The password can therefore be omitted from the \
                             command-line in future invocations')
     else:  # No password provided, login with token
         # Using token in existing .secret file
-        if os.path.isfile(TOML['config']['mastodon_user'] + '.secret'):
+        user_secret = token_file(destination)
+        if os.path.isfile(user_secret):
             try:
                 mastodon = Mastodon(
-                    access_token=TOML['config']['mastodon_user'] + '.secret',
-                    api_base_url='https://' +
-                    TOML['config']['mastodon_instance']
+                    access_token=user_secret,
+                    api_base_url='https://' + instance,
+                    session=session
                 )
 
             except MastodonError as me:
-                logging.fatal(
-                    'Login to ' + TOML['config']['mastodon_instance'] + ' Failed\n')
-                logging.fatal(me)
-                terminate(-1)
+                logging.error('Login to ' + instance + ' Failed\n')
+                logging.error(me)
+                return None
         else:
-            logging.fatal('No .secret file found. Password required to log in')
-            terminate(-1)
+            logging.error('No .secret file found for ' + user + ' on ' + instance + '. Password required to log in')
+            return None
 
     return mastodon
 
 
+def login_destinations(session, password):
+    """
+    Login to the Mastodon accounts of all destinations
+    A destination whose login failed is kept with no mastodon object so that its
+    statuses are reported as failed while the other destinations are served
+    :param session: HTTP client returned by build_session()
+    :param password: Password associated to account. None if not provided. With several
+                     destinations, only used for the accounts that have no .secret file yet
+    :return: list of (destination, mastodon object or None) tuples
+    """
+    accounts = []
+    for destination in TOML['destinations']:
+        account_password = password
+        if len(TOML['destinations']) > 1 and os.path.isfile(token_file(destination)):
+            account_password = None
+        accounts.append((destination, login(session, account_password, destination)))
+
+    if all(mastodon is None for destination, mastodon in accounts):
+        logging.fatal('Could not log in to any Mastodon account')
+        terminate(-1)
+
+    return accounts
+
+
+def prune_log_segments(base_name, log_days):
+    """
+    Delete the daily log files that are older than log_days
+    Files are deleted whole, so this is cheap and safe if several processes do it at the same time
+    :param base_name: name of log file. Daily files are named <base_name>.YYYY-MM-DD
+    :param log_days: number of days to keep log files for
+    """
+    today = date.today()
+    for segment in Path('.').glob(base_name + '.*'):
+        try:
+            day = datetime.strptime(segment.name[len(base_name) + 1:], '%Y-%m-%d').date()
+        except ValueError:
+            # Not a daily log file
+            continue
+
+        if (today - day).days >= log_days:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                # Already deleted by another process
+                pass
+
+
+class DailyLogHandler(logging.FileHandler):
+    """
+    Log handler writing the messages of each day in their own file
+    Files are opened in append mode so that several processes can log at the same time.
+    Files older than log_days are deleted when a new file is started
+    """
+    def __init__(self, base_name, log_days):
+        self.base_name = base_name
+        self.log_days = log_days
+        self.day = date.today()
+        super().__init__(base_name + '.' + self.day.isoformat(), mode='a', encoding='utf-8', delay=True)
+        prune_log_segments(base_name, log_days)
+
+    def emit(self, record):
+        day = date.fromtimestamp(record.created)
+        if day != self.day:
+            # Switch to the file of the new day (long running process)
+            self.day = day
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(self.base_name + '.' + day.isoformat())
+            prune_log_segments(self.base_name, self.log_days)
+
+        super().emit(record)
+
+
+def write_metrics(exit_code=None):
+    """
+    Write the metrics of the process to the files configured with metrics_json_path
+    (one JSON line appended per run) and metrics_prom_path (Prometheus text format
+    for the textfile collector of node_exporter, replaced atomically)
+    :param exit_code: exit code of the run. None if the process keeps running
+    """
+    import json
+
+    json_path = TOML['options'].get('metrics_json_path', '')
+    prom_path = TOML['options'].get('metrics_prom_path', '')
+    if json_path == '' and prom_path == '':
+        return
+
+    now = time.time()
+    with METRICS_LOCK:
+        stages = {stage: dict(stats) for stage, stats in METRICS['stages'].items()}
+        counters = dict(METRICS['counters'])
+
+    try:
+        if json_path != '':
+            line = {
+                'timestamp': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                'run_seconds': round(now - START_TIME, 3),
+                'exit_code': exit_code,
+                'stages': stages,
+                'counters': counters,
+            }
+            with open(json_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(line) + '\n')
+
+        if prom_path != '':
+            lines = [
+                '# HELP twoot_run_seconds Duration of the run',
+                '# TYPE twoot_run_seconds gauge',
+                'twoot_run_seconds ' + repr(now - START_TIME),
+                '# HELP twoot_last_run_timestamp_seconds Time of the last update of the metrics',
+                '# TYPE twoot_last_run_timestamp_seconds gauge',
+                'twoot_last_run_timestamp_seconds ' + repr(now),
+                '# HELP twoot_stage_seconds Time spent in each stage of processing during the run',
+                '# TYPE twoot_stage_seconds gauge',
+            ]
+            lines += ['twoot_stage_seconds{stage="' + stage + '"} ' + repr(stats['seconds'])
+                      for stage, stats in sorted(stages.items())]
+            lines += [
+                '# HELP twoot_stage_max_seconds Longest execution of each stage of processing during the run',
+                '# TYPE twoot_stage_max_seconds gauge',
+            ]
+            lines += ['twoot_stage_max_seconds{stage="' + stage + '"} ' + repr(stats['max_seconds'])
+                      for stage, stats in sorted(stages.items())]
+            lines += [
+                '# HELP twoot_stage_executions Number of executions of each stage of processing during the run',
+                '# TYPE twoot_stage_executions gauge',
+            ]
+            lines += ['twoot_stage_executions{stage="' + stage + '"} ' + str(stats['count'])
+                      for stage, stats in sorted(stages.items())]
+            for counter, value in sorted(counters.items()):
+                lines += ['# TYPE twoot_' + counter + ' gauge', 'twoot_' + counter + ' ' + str(value)]
+            if exit_code is not None:
+                lines += ['# TYPE twoot_exit_code gauge', 'twoot_exit_code ' + str(exit_code)]
+
+            # node_exporter must never read a partially written file
+            with open(prom_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(prom_path + '.tmp', prom_path)
+
+    except OSError as e:
+        logging.error('Could not write metrics: ' + str(e))
+
+
 def terminate(exit_code):
     """
     Cleanly stop execution with a message on execution duration
-    Remove log messages older that duration specified in config from log file
     :param exit_code: return value to pass to shell when exiting
     """
     logging.info('Run time : {t:2.1f} seconds.'.format(
         t=time.time() - START_TIME))
+    logging.info('URL cache: {h} hits, {m} misses'.format(
+        h=METRICS['counters'].get('url_cache_hits', 0), m=METRICS['counters'].get('url_cache_misses', 0)))
+    logging.info('Media cache: {h} hits, {m} misses, {r} uploads reused'.format(
+        h=METRICS['counters'].get('media_cache_hits', 0), m=METRICS['counters'].get('media_cache_misses', 0),
+        r=METRICS['counters'].get('media_ids_reused', 0)))
+    write_metrics(exit_code)
     logging.info(
         '_____________________________________________________________________________________')
 
     # Close logger and log file
     logging.shutdown()
 
-    # Remove older log messages
-    # Max allowed age of log message
-    max_delta = timedelta(TOML['options']['log_days'])
+    exit(exit_code)
+
 
-    # Open log file
-    log_file_name = 'twoot.log'
-    new_log_file_name = 'twoot.log.new'
-    try:
-        log_file = open(log_file_name, 'r')
-    except FileNotFoundError:
-        # Nothing to do if there is no log file
-        exit(exit_code)
+class CountingRetry(Retry):
+    """
+    Retry policy of urllib3 that counts the retries in the metrics
+    """
+    def increment(self, *args, **kwargs):
+        count_metric('http_retries')
+        return super().increment(*args, **kwargs)
 
-    # Check each line
-    pos = log_file.tell()
-    while True:
-        line = log_file.readline()
-        # Check if we reached the end of the file
-        if not line:
-            exit(exit_code)
 
-        try:
-            # Extract date on log line
-            date = datetime.strptime(line[:10], '%Y-%m-%d')
-        except ValueError:
-            # date was not found on this line, try next one
-            continue
+def build_session():
+    """
+    Create the HTTP client shared by every network call of the process
+    Connections are pooled per host and kept alive between requests.
+    Idempotent requests that fail on connection errors or server errors are
+    retried with exponential backoff. A user agent is picked at random
+    :return: requests session
+    """
+    session = requests.Session()
 
-        # Time difference between log message and now
-        log_delta = datetime.now() - date
-        # Only keep the number of days of the difference
-        log_delta = timedelta(days=log_delta.days)
-        if log_delta < max_delta:
-            logging.debug("Truncating log file")
-            # Reset file pointer to position before reading last line
-            log_file.seek(pos)
-            remainder = log_file.read()
-            output_file = open(new_log_file_name, 'w')
-            output_file.write(remainder)
-            output_file.close()
-            # replace log file by new one
-            shutil.move(new_log_file_name, log_file_name)
-
-            break  # Exit while loop
-
-        # Update read pointer position
-        pos = log_file.tell()
+    retries = CountingRetry(total=HTTP_RETRIES, backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=('HEAD', 'GET'), raise_on_status=False)
+    # Keep enough connections per host for all the media workers
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS,
+                          pool_maxsize=max(HTTP_POOL_SIZE, TOML['options']['media_workers']),
+                          max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
 
-    exit(exit_code)
+    # Update default headers with randomly selected user agent
+    session.headers.update(
+        {
+            'User-Agent': USER_AGENTS[random.randint(0, len(USER_AGENTS) - 1)],
+        }
+    )
+
+    return session
 
 
 def basic_auth(username, password):
     token = b64encode(f"{username}:{password}".encode('utf-8')).decode("ascii")
     return f'Basic {token}'
 
-def main(argv):
-    # Start stopwatch
-    global START_TIME
-    START_TIME = time.time()
-
-    # Build parser for command line arguments
-    parser = argparse.ArgumentParser(description='toot tweets.')
-    parser.add_argument('-f', metavar='<.toml config file>', action='store')
-    parser.add_argument('-t', metavar='<twitter status>', action='store')
-    parser.add_argument('-i', metavar='<mastodon instance>', action='store')
-    parser.add_argument('-m', metavar='<mastodon account>', action='store')
-    parser.add_argument('-p', metavar='<mastodon password>', action='store')
-    parser.add_argument('-l', action='store_true',
-                        help='Remove link redirection')
-    parser.add_argument('-u', action='store_true',
-                        help='Remove trackers from URLs')
-    parser.add_argument('-v', action='store_true',
-                        help='Ingest twitter videos and upload to Mastodon instance')
-    parser.add_argument('-o', action='store_true',
-                        help='Do not add reference to Original tweet')
-    parser.add_argument('-j', metavar='<json export path>', action='store')
 
-    # Parse command line
-    args = vars(parser.parse_args())
+def read_status_list(list_path):
+    """
+    Read the list of twitter statuses to process in batch mode
+    Empty lines and lines starting with '#' are ignored
+    :param list_path: path of file with one status URL per line. '-' for stdin
+    :return: list of status URLs
+    """
+    if list_path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(list_path, 'r', encoding='utf-8') as list_file:
+                lines = list_file.readlines()
+        except FileNotFoundError:
+            logging.fatal('Batch file ' + list_path + ' not found')
+            terminate(-1)
 
-    build_config(args)
+    statuses = []
+    for line in lines:
+        line = line.strip()
+        if line != '' and not line.startswith('#'):
+            statuses.append(line)
 
-    mast_password = args['p']
+    return statuses
 
-    # Setup logging to file
-    logging.basicConfig(
-        filename='twoot.log',
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-    )
 
-    # log level as an uppercase string from config
-    ll_str = TOML['options']['log_level'].upper()
+def db_connect():
+    """
+    Open the local database used to persist state between runs
+    A new connection is opened for each use so that it can be called from any thread.
+    The tables are created by the first connection of the process
+    :return: sqlite3 connection
+    """
+    db = sqlite3.connect(DB_FILE, timeout=30)
+    if DB_FILE not in DB_SCHEMA_READY:
+        with DB_SCHEMA_LOCK:
+            if DB_FILE not in DB_SCHEMA_READY:
+                _create_schema(db)
+                DB_SCHEMA_READY.add(DB_FILE)
+    return db
 
-    if ll_str == "DEBUG":
-        log_level = logging.DEBUG
-    elif ll_str == "INFO":
-        log_level = logging.INFO
-    elif ll_str == "WARNING":
-        log_level = logging.WARNING
-    elif ll_str == "ERROR":
-        log_level = logging.ERROR
-    elif ll_str == "CRITICAL":
-        log_level == logging.CRITICAL
-    elif ll_str == "OFF":
-        # Disable all logging
-        logging.disable(logging.CRITICAL)
-    else:
-        logging.error('Invalid log_level %s in config file. Using WARNING.', str(
-            TOML['options']['log_level']))
 
-    # Set desired level of logging
-    logger = logging.getLogger()
-    logger.setLevel(log_level)
+def _create_schema(db):
+    """
+    private function
+    Create the tables of the local database that do not exist yet
+    :param db: sqlite3 connection
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS nitter_health (instance TEXT PRIMARY KEY,
+                  requests REAL, successes REAL, throttled REAL, latency REAL,
+                  last_code INTEGER, updated REAL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS toots (twitter_account TEXT, mastodon_instance TEXT,
+                  mastodon_account TEXT, tweet_id TEXT, toot_id TEXT)''')
+    db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS main_index ON toots
+                  (mastodon_instance, mastodon_account, tweet_id)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS url_cache (url TEXT, kind TEXT, value TEXT,
+                  stored REAL, last_used REAL, PRIMARY KEY (url, kind))''')
+    db.execute('''CREATE TABLE IF NOT EXISTS timeline_marks (twitter_account TEXT, mastodon_instance TEXT,
+                  mastodon_account TEXT, last_id TEXT, updated REAL,
+                  PRIMARY KEY (twitter_account, mastodon_instance, mastodon_account))''')
+    db.execute('''CREATE TABLE IF NOT EXISTS page_cache (author TEXT, status_id TEXT, nitter_url TEXT,
+                  etag TEXT, last_modified TEXT, html TEXT, tweet TEXT, options_key TEXT,
+                  fetched REAL, PRIMARY KEY (author, status_id))''')
+    db.execute('''CREATE TABLE IF NOT EXISTS media_cache (digest TEXT PRIMARY KEY, file TEXT,
+                  mime_type TEXT, size INTEGER, last_used REAL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS media_urls (url TEXT PRIMARY KEY, digest TEXT, fetched REAL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS media_ids (api_base_url TEXT, account TEXT, media_id TEXT,
+                  digest TEXT, uploaded REAL, available INTEGER,
+                  PRIMARY KEY (api_base_url, account, media_id))''')
+
+
+def _decay(value, age):
+    """
+    private function
+    Reduce the weight of a statistic according to its age
+    :param value: weighted count
+    :param age: seconds since the statistic was last updated
+    :return: decayed count
+    """
+    return value * 0.5 ** (max(age, 0) / NITTER_HEALTH_HALF_LIFE)
 
-    logging.info('Running with the following configuration:')
-    logging.info('  Config File              : ' + str(args['f']))
-    logging.info('  twitter_status          : ' +
-                 TOML['config']['twitter_status'])
 
-    if 'mastodon_instance' in TOML['config'].keys():
-        logging.info('  mastodon_instance        : ' +
-                     TOML['config']['mastodon_instance'])
+def _nitter_score(row, now):
+    """
+    private function
+    Compute health score of a nitter instance from its statistics
+    Unknown instances score 0.5. Failures, throttling and latency lower the score
+    :param row: tuple (requests, successes, throttled, latency, last_code, updated) or None
+    :param now: current time
+    :return: score between 0 and 1
+    """
+    if row is None:
+        return 0.5
 
-    if 'mastodon_user' in TOML['config'].keys():
-        logging.info('  mastodon_user            : ' +
-                     TOML['config']['mastodon_user'])
+    reqs, successes, throttled, latency, last_code, updated = row
+    age = now - updated
+    reqs = _decay(reqs, age)
+    successes = _decay(successes, age)
+    throttled = _decay(throttled, age)
 
-    logging.info('  upload_videos            : ' +
-                 str(TOML['options']['upload_videos']))
-    logging.info('  remove_link_redirections : ' +
-                 str(TOML['options']['remove_link_redirections']))
-    logging.info('  remove_trackers_from_urls: ' +
-                 str(TOML['options']['remove_trackers_from_urls']))
-    logging.info('  footer                   : ' + TOML['options']['footer'])
-    logging.info('  remove_original_tweet_ref: ' +
-                 str(TOML['options']['remove_original_tweet_ref']))
-    logging.info('  subst_twitter            : ' +
-                 str(TOML['options']['subst_twitter']))
-    logging.info('  subst_twitter            : ' +
-                 str(TOML['options']['subst_youtube']))
-    logging.info('  subst_twitter            : ' +
-                 str(TOML['options']['subst_reddit']))
-    logging.info('  log_level                : ' +
-                 str(TOML['options']['log_level']))
-    logging.info('  log_days                 : ' +
-                 str(TOML['options']['log_days']))
-    logging.info('  export_json_path                 : ' +
-                 str(TOML['options']['export_json_path']))
+    # Laplace smoothing so that old statistics slowly return to neutral
+    score = (successes + 1) / (reqs + 2)
+    # 429 and 403 responses mean that the instance is pushing back: penalise more
+    score *= 1 - throttled / (reqs + 2)
+    # Slow instances are penalised relative to the request timeout
+    score /= 1 + latency / HTTPS_REQ_TIMEOUT
 
-    # Select random nitter instance to fetch updates from
-    nitter_url = NITTER_URLS[random.randint(0, len(NITTER_URLS) - 1)]
+    return score
 
-    # **********************************************************
-    # Load twitter page of user. Process all tweets and generate
-    # list of dictionaries ready to be posted on Mastodon
-    # **********************************************************
-    # To store content of all tweets from this user
-    tweets = []
 
-    # Initiate session
-    session = requests.Session()
+def record_nitter_result(nitter_url, status_code, latency):
+    """
+    Update the health statistics of a nitter instance after a request
+    :param nitter_url: url of nitter mirror
+    :param status_code: HTTP status of the response. None if there was no response
+    :param latency: seconds taken by the request
+    """
+    now = time.time()
+    try:
+        with closing(db_connect()) as db, db:
+            row = db.execute('''SELECT requests, successes, throttled, latency, last_code, updated
+                                FROM nitter_health WHERE instance=?''', (nitter_url,)).fetchone()
+            if row is None:
+                reqs, successes, throttled, avg_latency = 0, 0, 0, latency
+            else:
+                age = now - row[5]
+                reqs = _decay(row[0], age)
+                successes = _decay(row[1], age)
+                throttled = _decay(row[2], age)
+                # Exponentially weighted moving average of latency
+                avg_latency = 0.7 * row[3] + 0.3 * latency
+
+            reqs += 1
+            if status_code in (200, 304):
+                successes += 1
+            elif status_code in (403, 429):
+                throttled += 1
+
+            db.execute('''INSERT OR REPLACE INTO nitter_health VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                       (nitter_url, reqs, successes, throttled, avg_latency, status_code, now))
+    except sqlite3.Error as e:
+        # Health statistics are only an optimisation
+        logging.warning('Could not record health of ' + nitter_url + ': ' + str(e))
+
+
+def url_cache_get(url, kind):
+    """
+    Look up metadata of a URL in the persistent cache
+    :param url: url the metadata is about
+    :param kind: type of metadata ('redirect' or 'preview')
+    :return: cached value. None if not cached or expired
+    """
+    now = time.time()
+    value = None
+    try:
+        with closing(db_connect()) as db, db:
+            row = db.execute('''SELECT value, stored FROM url_cache WHERE url=? AND kind=?''',
+                             (url, kind)).fetchone()
+            if row is not None and now - row[1] < TOML['options']['url_cache_days'] * 86400:
+                value = row[0]
+                db.execute('''UPDATE url_cache SET last_used=? WHERE url=? AND kind=?''',
+                           (now, url, kind))
+    except sqlite3.Error as e:
+        logging.warning('Could not read URL cache: ' + str(e))
 
-    # Get a copy of the default headers that requests would use
-    headers = requests.utils.default_headers()
+    count_metric('url_cache_misses' if value is None else 'url_cache_hits')
 
-    # Update default headers with randomly selected user agent
-    headers.update(
-        {
-            'User-Agent': USER_AGENTS[random.randint(0, len(USER_AGENTS) - 1)],
-            'Cookie': 'replaceTwitter=; replaceYouTube=; hlsPlayback=on; proxyVideos='
-        }
-    )
+    return value
 
-    if USE_AUTH:
-        headers.update({'Authorization' : basic_auth("root", "hunter2")})
 
-    url = clean_url(TOML['config']['twitter_status'])
+def url_cache_put(url, kind, value):
+    """
+    Store metadata of a URL in the persistent cache
+    Least recently used entries are evicted above url_cache_max_entries
+    :param url: url the metadata is about
+    :param kind: type of metadata ('redirect' or 'preview')
+    :param value: metadata to store
+    """
+    now = time.time()
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''INSERT OR REPLACE INTO url_cache VALUES (?, ?, ?, ?, ?)''',
+                       (url, kind, value, now, now))
+            db.execute('''DELETE FROM url_cache WHERE rowid IN (SELECT rowid FROM url_cache
+                          ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                       (TOML['options']['url_cache_max_entries'],))
+    except sqlite3.Error as e:
+        logging.warning('Could not write URL cache: ' + str(e))
 
-    status_id = url.split("/")[-1].split("?")[0]
-    status_author = url.split("x.com/")[-1].split("/")[0]
 
-    logging.debug('processing tweet %s', status_id)
+def media_cache_get(session, url):
+    """
+    Get a picture from the media cache, downloading it unless its URL was seen recently
+    Pictures are stored once per content, named after its digest, whatever their URL.
+    The least recently used ones are evicted above media_cache_max_mb
+    :param session: HTTP client returned by build_session()
+    :param url: url of picture
+    :return: tuple (path of file, mime type, digest of content). None if the picture could not be downloaded
+    """
+    import mimetypes
+
+    now = time.time()
+    try:
+        with closing(db_connect()) as db, db:
+            row = db.execute('''SELECT media_cache.digest, file, mime_type FROM media_urls
+                                JOIN media_cache ON media_urls.digest = media_cache.digest
+                                WHERE url=? AND fetched>?''',
+                             (url, now - TOML['options']['media_cache_days'] * 86400)).fetchone()
+            if row is not None and os.path.isfile(os.path.join(MEDIA_CACHE_DIR, row[1])):
+                db.execute('''UPDATE media_cache SET last_used=? WHERE digest=?''', (now, row[0]))
+                count_metric('media_cache_hits')
+                return os.path.join(MEDIA_CACHE_DIR, row[1]), row[2], row[0]
+    except sqlite3.Error as e:
+        logging.warning('Could not read media cache: ' + str(e))
+
+    count_metric('media_cache_misses')
+    os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=MEDIA_CACHE_DIR, delete=False) as staged:
+        mime_type = download_photo(session, url, staged)
+    if mime_type is None:
+        os.remove(staged.name)
+        return None
+
+    digest = hashlib.sha256()
+    for chunk in _file_chunks(staged.name):
+        digest.update(chunk)
+    digest = digest.hexdigest()
+    file_name = digest + (mimetypes.guess_extension(mime_type.split(';')[0].strip()) or '')
+    size = os.path.getsize(staged.name)
+    # Concurrent downloads of the same content replace the file with identical bytes
+    os.replace(staged.name, os.path.join(MEDIA_CACHE_DIR, file_name))
+
+    evicted = []
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''INSERT OR REPLACE INTO media_cache VALUES (?, ?, ?, ?, ?)''',
+                       (digest, file_name, mime_type, size, now))
+            db.execute('''INSERT OR REPLACE INTO media_urls VALUES (?, ?, ?)''', (url, digest, now))
+
+            # Keep the most recently used pictures up to the size limit. The new one always stays
+            total = 0
+            for entry_digest, entry_file, entry_size in db.execute(
+                    '''SELECT digest, file, size FROM media_cache ORDER BY last_used DESC''').fetchall():
+                total += entry_size
+                if total > TOML['options']['media_cache_max_mb'] * 1024 * 1024 and entry_digest != digest:
+                    evicted.append(entry_file)
+                    db.execute('''DELETE FROM media_cache WHERE digest=?''', (entry_digest,))
+            db.execute('''DELETE FROM media_urls WHERE fetched<=? OR digest NOT IN
+                          (SELECT digest FROM media_cache)''',
+                       (now - TOML['options']['media_cache_days'] * 86400,))
+    except sqlite3.Error as e:
+        logging.warning('Could not write media cache: ' + str(e))
+
+    for entry_file in evicted:
+        try:
+            os.remove(os.path.join(MEDIA_CACHE_DIR, entry_file))
+        except FileNotFoundError:  # Removed by a concurrent job
+            pass
+
+    return os.path.join(MEDIA_CACHE_DIR, file_name), mime_type, digest
 
-    url = nitter_url + '/' + status_author + '/status/' + status_id
 
-    # Download twitter page
+def _media_account(mastodon):
+    """
+    private function
+    :param mastodon: mastodon object returned by login()
+    :return: tuple (api base url, fingerprint of access token) identifying the account media are uploaded to
+    """
+    return mastodon.api_base_url, hashlib.sha1(str(mastodon.access_token).encode('utf-8')).hexdigest()
+
+
+def media_id_claim(mastodon, digest):
+    """
+    Take a picture uploaded earlier to the account and not attached to any toot, for reuse
+    The media is checked on the instance, which deletes unattached media after some time
+    :param mastodon: mastodon object returned by login()
+    :param digest: digest of content of picture
+    :return: media dict returned by the Mastodon API. None if no uploaded picture can be reused
+    """
+    from mastodon import MastodonError
+
+    api_base_url, account = _media_account(mastodon)
+    media_id = None
     try:
-        twit_page = session.get(
-            url, headers=headers, timeout=HTTPS_REQ_TIMEOUT)
-    except requests.exceptions.ConnectionError:
-        logging.fatal('Host did not respond when trying to download ' + url)
-        terminate(-1)
-    except requests.exceptions.Timeout:
-        logging.fatal(nitter_url + ' took too long to respond')
-        terminate(-1)
+        with closing(db_connect()) as db, db:
+            row = db.execute('''SELECT media_id FROM media_ids WHERE api_base_url=? AND account=? AND digest=?
+                                AND available=1 AND uploaded>?''',
+                             (api_base_url, account, digest, time.time() - MEDIA_ID_TTL)).fetchone()
+            # Concurrent jobs must not attach the same media to different toots
+            if row is not None and db.execute('''UPDATE media_ids SET available=0 WHERE api_base_url=? AND
+                                                 account=? AND media_id=? AND available=1''',
+                                              (api_base_url, account, row[0])).rowcount == 1:
+                media_id = row[0]
+    except sqlite3.Error as e:
+        logging.warning('Could not read uploaded media: ' + str(e))
+
+    if media_id is None:
+        return None
 
-    # Verify that download worked
-    if twit_page.status_code != 200:
-        logging.fatal('The Nitter page did not download correctly from ' + url + ' (' + str(
-            twit_page.status_code) + '). Aborting')
-        terminate(-1)
+    try:
+        with host_slot(api_base_url):
+            media = mastodon.media(media_id)
+    except MastodonError:  # Deleted by the instance or already attached
+        media_id_forget(mastodon, [media_id])
+        return None
 
-    logging.debug('Nitter page downloaded successfully from ' + url)
+    logging.debug('reusing media ' + str(media_id) + ' uploaded to ' + api_base_url)
+    count_metric('media_ids_reused')
+    return media
 
-    # DEBUG: Save page to file
-    # of = open(toml['config']['twitter_account'] + '.html', 'w')
-    # of.write(twit_page.text)
-    # of.close()
 
-    # Make soup
-    soup = BeautifulSoup(twit_page.text, 'html.parser')
+def media_id_put(mastodon, digest, media_id):
+    """
+    Record a picture uploaded to the account. It can only be reused once released
+    :param mastodon: mastodon object returned by login()
+    :param digest: digest of content of picture
+    :param media_id: id of media returned by the Mastodon API
+    """
+    api_base_url, account = _media_account(mastodon)
+    now = time.time()
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''INSERT OR REPLACE INTO media_ids VALUES (?, ?, ?, ?, ?, 0)''',
+                       (api_base_url, account, str(media_id), digest, now))
+            db.execute('''DELETE FROM media_ids WHERE uploaded<=?''', (now - MEDIA_ID_TTL,))
+    except sqlite3.Error as e:
+        logging.warning('Could not record uploaded media: ' + str(e))
 
-    # Replace twitter_account with version with correct capitalization
-    # ta = soup.find('meta', property='og:title').get('content')
-    # ta_match = re.search(r'\(@(.+)\)', ta)
-    # if ta_match is not None:
-    #     TOML['config']['twitter_account'] = ta_match.group(1)
 
-    # Extract twitter post
-    status = soup.body.find("div", attrs={
-                            'class': 'main-tweet'}).find("div", attrs={'class': 'timeline-item'})
+def media_id_release(mastodon, media_ids):
+    """
+    Make uploaded pictures that were not attached to a toot available for reuse
+    :param mastodon: mastodon object returned by login()
+    :param media_ids: list of ids of media returned by the Mastodon API
+    """
+    api_base_url, account = _media_account(mastodon)
+    try:
+        with closing(db_connect()) as db, db:
+            db.executemany('''UPDATE media_ids SET available=1 WHERE api_base_url=? AND account=? AND media_id=?''',
+                           [(api_base_url, account, str(media_id)) for media_id in media_ids])
+    except sqlite3.Error as e:
+        logging.warning('Could not record uploaded media: ' + str(e))
 
-    # **********************************************************
-    # Process each tweet and generate dictionary
-    # with data ready to be posted on Mastodon
-    # **********************************************************
 
-    # Extract time stamp
-    time_string = status.find('span', class_='tweet-date').a.get('title')
+def media_id_forget(mastodon, media_ids):
+    """
+    Forget uploaded pictures that were attached to a toot, as the instance does not accept them again
+    :param mastodon: mastodon object returned by login()
+    :param media_ids: list of ids of media returned by the Mastodon API
+    """
+    api_base_url, account = _media_account(mastodon)
     try:
-        timestamp = datetime.strptime(
-            time_string, '%d/%m/%Y, %H:%M:%S').timestamp()
-    except:
-        # Dec 21, 2021 · 12:00 PM UTC
-        timestamp = datetime.strptime(
-            time_string, '%b %d, %Y · %I:%M %p %Z').timestamp()
+        with closing(db_connect()) as db, db:
+            db.executemany('''DELETE FROM media_ids WHERE api_base_url=? AND account=? AND media_id=?''',
+                           [(api_base_url, account, str(media_id)) for media_id in media_ids])
+    except sqlite3.Error as e:
+        logging.warning('Could not record uploaded media: ' + str(e))
 
-    # extract author
-    author = status.find('a', class_='fullname').get('title')
 
-    # Extract user name
-    author_account = status_author
+def _tweet_options_key():
+    """
+    private function
+    :return: fingerprint of the options that change the content of tweets extracted from a page
+    """
+    import json
 
-    # Extract URL of full status page (for video download)
-    full_status_url = clean_url(TOML['config']['twitter_status'])
+    keys = ('footer', 'remove_original_tweet_ref', 'remove_link_redirections', 'remove_trackers_from_urls',
+            'tracker_rules_files', 'subst_twitter', 'subst_youtube', 'subst_reddit', 'upload_videos',
+            'mirror_thread')
+    options = json.dumps([TOML['options'][key] for key in keys])
+    return hashlib.sha1(options.encode('utf-8')).hexdigest()
 
-    # Initialize containers
-    tweet_text = ''
-    photos = []
 
-    # Add prefix if the tweet is a reply-to
-    # Only consider item of class 'replying-to' that is a direct child
-    # of class 'tweet-body' in status. Others can be in a quoted tweet.
-    #replying_to_class = status.select("div.tweet-body > div.replying-to")
-    # if len(replying_to_class) != 0:
-    #    tweet_text += 'Replying to ' + \
-    #        replying_to_class[0].a.get_text() + '\n\n'
+def page_cache_get(author, status_id):
+    """
+    Look up a nitter status page in the persistent page cache
+    :param author: account of author of tweet
+    :param status_id: id of tweet
+    :return: dictionary with keys nitter_url, etag, last_modified, html, tweet and fetched.
+             tweet is None if it was extracted with other options. None if not cached or expired
+    """
+    import json
 
-    # extract iterator over tweet text contents
-    tt_iter = status.find(
-        'div', class_='tweet-content media-body').children
+    if TOML['options']['page_cache_days'] <= 0:
+        return None
 
-    # Process text of tweet
-    tweet_text += process_media_body(tt_iter)
+    row = None
+    try:
+        with closing(db_connect()) as db:
+            row = db.execute('''SELECT nitter_url, etag, last_modified, html, tweet, options_key, fetched
+                                FROM page_cache WHERE author=? AND status_id=?''',
+                             (author, status_id)).fetchone()
+    except sqlite3.Error as e:
+        logging.warning('Could not read page cache: ' + str(e))
 
-    # Process quote: append link to tweet_text
-    quote_div = status.find('a', class_='quote-link')
-    if quote_div is not None:
-        tweet_text += "\n\nRE: " + substitute_source('\n\nhttps://x.com' +
-                                        quote_div.get('href').strip('#m'))
-    # Process card : extract image if necessary
-    card_class = status.find('a', class_='card-container')
-    if card_class is not None:
-        photos.extend(process_card(nitter_url, card_class))
+    if row is None or time.time() - row[6] >= TOML['options']['page_cache_days'] * 86400:
+        return None
 
-    # Process attachment: capture image or .mp4 url or download twitter video
-    attachments_class = status.find('div', class_='attachments')
-    if attachments_class is not None:
-        pics, vid_in_tweet = process_attachments(nitter_url,
-                                                 attachments_class,
-                                                 status_id, author_account
-                                                 )
-        photos.extend(pics)
+    tweet = None
+    if row[4] is not None and row[5] == _tweet_options_key():
+        tweet = json.loads(row[4])
 
-    # Add custom footer from config file
-    if TOML['options']['footer'] != '':
-        tweet_text += '\n\n' + TOML['options']['footer']
+    return {'nitter_url': row[0], 'etag': row[1], 'last_modified': row[2], 'html': row[3],
+            'tweet': tweet, 'fetched': row[6]}
 
-    # Add footer with link to original tweet
-    if TOML['options']['remove_original_tweet_ref'] == False:
-        if TOML['options']['footer'] != '':
-            tweet_text += '\nOriginal tweet: ' + \
-                substitute_source(full_status_url)
-        else:
-            tweet_text += '\n\nOriginal tweet: ' + \
-                substitute_source(full_status_url)
 
-    # If no media was specifically added in the tweet, try to get the first picture
-    # with "twitter:image" meta tag in first linked page in tweet text
-    if not photos:
-        m = re.search(r"http[^ \n\xa0]*", tweet_text)
-        if m is not None:
-            link_url = m.group(0)
-            if link_url.endswith(".html"):  # Only process a web page
-                try:
-                    r = requests.get(link_url, timeout=HTTPS_REQ_TIMEOUT)
-                    if r.status_code == 200:
-                        # Matches the first instance of either twitter:image or twitter:image:src meta tag
-                        match = re.search(
-                            r'<meta name="twitter:image(?:|:src)" content="(.+?)".*?>', r.text)
-                        if match is not None:
-                            # Remove HTML-safe encoding from URL if any
-                            url = match.group(1).replace('&amp;', '&')
-                            photos.append(url)
-                # Give up if anything goes wrong
-                except (requests.exceptions.ConnectionError,
-                        requests.exceptions.Timeout,
-                        requests.exceptions.ContentDecodingError,
-                        requests.exceptions.TooManyRedirects,
-                        requests.exceptions.MissingSchema):
-                    pass
-                else:
-                    logging.debug(
-                        "downloaded twitter:image from linked page")
+def page_cache_put(author, status_id, nitter_url, page):
+    """
+    Store a nitter status page and its validators in the persistent page cache
+    Entries older than page_cache_days are evicted
+    :param author: account of author of tweet
+    :param status_id: id of tweet
+    :param nitter_url: url of the nitter instance that delivered the page
+    :param page: response of the nitter instance
+    """
+    if TOML['options']['page_cache_days'] <= 0:
+        return
 
-    # Check if video was downloaded
-    video_file = []
+    now = time.time()
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''INSERT OR REPLACE INTO page_cache VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)''',
+                       (author, status_id, nitter_url, page.headers.get('ETag'),
+                        page.headers.get('Last-Modified'), page.text, now))
+            db.execute('''DELETE FROM page_cache WHERE fetched < ?''',
+                       (now - TOML['options']['page_cache_days'] * 86400,))
+    except sqlite3.Error as e:
+        logging.warning('Could not write page cache: ' + str(e))
 
-    video_path = Path('./output') / status_id
-    if video_path.exists():
-        # list video files
-        video_file_list = list(video_path.glob('*.mp4'))
-        for video in video_file_list:
-            video_file.append(video.absolute().as_posix())
 
-    # Add dictionary with content of tweet to list
-    tweet = {
-        "author": author,
-        "author_account": author_account,
-        "timestamp": timestamp,
-        "tweet_id": status_id,
-        "tweet_text": tweet_text,
-        "video": video_file,
-        "photos": photos,
-    }
+def page_cache_touch(author, status_id):
+    """
+    Restart the freshness window of a cached page after the nitter instance confirmed it is unchanged
+    :param author: account of author of tweet
+    :param status_id: id of tweet
+    """
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''UPDATE page_cache SET fetched=? WHERE author=? AND status_id=?''',
+                       (time.time(), author, status_id))
+    except sqlite3.Error as e:
+        logging.warning('Could not write page cache: ' + str(e))
 
-    if 'export_json_path' in TOML['options'].keys():
-        import json
 
-        jsonpath = TOML['options']['export_json_path']
-        with open(jsonpath, "w", encoding='utf-8') as jsonfile:
-            json.dump(tweet, jsonfile, indent=2, ensure_ascii=False)
+def page_cache_put_tweet(author, status_id, tweet):
+    """
+    Store the tweet extracted from a cached page so that it does not need to be parsed again
+    :param author: account of author of tweet
+    :param status_id: id of tweet
+    :param tweet: dictionary with content of tweet built by process_status()
+    """
+    import json
 
-        logging.info('Exported Tweet JSON data to ' + jsonpath)
-        exit(0)
+    if TOML['options']['page_cache_days'] <= 0:
+        return
 
-    # Login to account on maston instance
-    mastodon = login(mast_password)
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''UPDATE page_cache SET tweet=?, options_key=? WHERE author=? AND status_id=?''',
+                       (json.dumps(tweet, ensure_ascii=False), _tweet_options_key(), author, status_id))
+    except sqlite3.Error as e:
+        logging.warning('Could not write page cache: ' + str(e))
 
-    # **********************************************************
-    # Post tweet on Mastodon
-    # **********************************************************
 
-    logging.debug('Uploading Tweet %s', tweet["tweet_id"])
+def find_posted_toot(tweet_id, destination):
+    """
+    Look up in the local database if a tweet was already mirrored on the Mastodon account
+    :param tweet_id: id of tweet
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    :return: id of the toot it was posted as. None if it was not posted yet
+    """
+    try:
+        with closing(db_connect()) as db:
+            row = db.execute('''SELECT toot_id FROM toots WHERE mastodon_instance=? AND
+                                mastodon_account=? AND tweet_id=?''',
+                             (destination['mastodon_instance'],
+                              destination['mastodon_user'], tweet_id)).fetchone()
+    except sqlite3.Error as e:
+        logging.warning('Could not read posted toots from database: ' + str(e))
+        return None
 
-    media_ids = []
+    return row[0] if row is not None else None
 
-    # Upload video if there is one
-    if tweet['video'] is not None:
-        try:
-            logging.debug("Uploading video to Mastodon")
-            media_posted = mastodon.media_post(tweet['video'])
-            media_ids.append(media_posted['id'])
-        except (MastodonAPIError, MastodonIllegalArgumentError,
-                TypeError):  # Media cannot be uploaded (invalid format, dead link, etc.)
-            logging.debug("Uploading video failed")
-            pass
 
-    else:  # Only upload pic if no video was uploaded
-        # Upload photos
-        for photo in tweet['photos']:
-            media = False
-            # Download picture
-            try:
-                logging.debug('downloading picture')
-                media = requests.get(photo, timeout=HTTPS_REQ_TIMEOUT)
-            except:  # Picture cannot be downloaded for any reason
-                pass
+def record_posted_toot(twitter_account, tweet_id, toot_id, destination):
+    """
+    Record a mirrored tweet in the local database
+    Only the max_records most recent records of each twitter account are kept
+    :param twitter_account: author of tweet
+    :param tweet_id: id of tweet
+    :param toot_id: id of the toot it was posted as
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    """
+    instance = destination['mastodon_instance']
+    user = destination['mastodon_user']
+    try:
+        with closing(db_connect()) as db, db:
+            db.execute('''INSERT OR REPLACE INTO toots VALUES (?, ?, ?, ?, ?)''',
+                       (twitter_account, instance, user, tweet_id, str(toot_id)))
+            db.execute('''DELETE FROM toots WHERE rowid IN (SELECT rowid FROM toots
+                          WHERE twitter_account=? AND mastodon_instance=? AND mastodon_account=?
+                          ORDER BY rowid DESC LIMIT -1 OFFSET ?)''',
+                       (twitter_account, instance, user, TOML['options']['max_records']))
+    except sqlite3.Error as e:
+        logging.error('Could not record toot of tweet ' + tweet_id + ' in database: ' + str(e))
+
+
+def get_timeline_mark(twitter_account, destination):
+    """
+    Get the id of the most recent status of the account already processed for the Mastodon account
+    :param twitter_account: account whose timeline is polled
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    :return: status id. None if the timeline was never polled
+    """
+    row = None
+    try:
+        with closing(db_connect()) as db:
+            row = db.execute('''SELECT last_id FROM timeline_marks WHERE twitter_account=?
+                                AND mastodon_instance=? AND mastodon_account=?''',
+                             (twitter_account.lower(), destination['mastodon_instance'],
+                              destination['mastodon_user'])).fetchone()
+    except sqlite3.Error as e:
+        logging.error('Could not read timeline mark of ' + twitter_account + ': ' + str(e))
 
-            # Upload picture to Mastodon instance
-            if media:
-                try:
-                    logging.debug('uploading picture to Mastodon')
-                    media_posted = mastodon.media_post(
-                        media.content, mime_type=media.headers['content-type'])
-                    media_ids.append(media_posted['id'])
-                except (MastodonAPIError, MastodonIllegalArgumentError,
-                        TypeError):  # Media cannot be uploaded (invalid format, dead link, etc.)
-                    pass
+    return row[0] if row is not None else None
 
-    # Post toot
-    toot = {}
+
+def set_timeline_mark(twitter_account, status_id, destination):
+    """
+    Record the id of the most recent status of the account processed for the Mastodon account
+    :param twitter_account: account whose timeline is polled
+    :param status_id: status id
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    """
     try:
-        if len(media_ids) == 0:
-            toot = mastodon.status_post(tweet['tweet_text'])
-        else:
-            toot = mastodon.status_post(
-                tweet['tweet_text'], media_ids=media_ids)
-
-    except MastodonAPIError:
-        # Assuming this is an:
-        # ERROR ('Mastodon API returned error', 422, 'Unprocessable Entity', 'Cannot attach files that have not finished processing. Try again in a moment!')
-        logging.warning(
-            'Mastodon API Error 422: Cannot attach files that have not finished processing. Waiting 15 seconds and retrying.')
-        # Wait 15 seconds
-        time.sleep(15)
-        # retry posting
+        with closing(db_connect()) as db, db:
+            db.execute('''INSERT OR REPLACE INTO timeline_marks VALUES (?, ?, ?, ?, ?)''',
+                       (twitter_account.lower(), destination['mastodon_instance'],
+                        destination['mastodon_user'], status_id, time.time()))
+    except sqlite3.Error as e:
+        logging.error('Could not record timeline mark of ' + twitter_account + ': ' + str(e))
+
+
+def rank_nitter_instances():
+    """
+    Order the nitter instances from healthiest to least healthy
+    Instances with the same score are shuffled to spread the load
+    :return: list of tuples (nitter url, score, statistics row or None)
+    """
+    now = time.time()
+    rows = {}
+    try:
+        with closing(db_connect()) as db:
+            for row in db.execute('''SELECT instance, requests, successes, throttled, latency,
+                                     last_code, updated FROM nitter_health'''):
+                rows[row[0]] = row[1:]
+    except sqlite3.Error as e:
+        logging.warning('Could not read nitter health statistics: ' + str(e))
+
+    ranking = [(url, _nitter_score(rows.get(url), now), rows.get(url)) for url in NITTER_URLS]
+    random.shuffle(ranking)
+    ranking.sort(key=lambda r: r[1], reverse=True)
+
+    return ranking
+
+
+def print_nitter_health():
+    """
+    Print the current health scores of the nitter instances
+    """
+    now = time.time()
+    print('{:<36} {:>6} {:>9} {:>8} {:>10} {:>9} {:>5}'.format(
+        'instance', 'score', 'requests', 'success', 'throttled', 'latency', 'last'))
+    for url, score, row in rank_nitter_instances():
+        if row is None:
+            print('{:<36} {:>6.3f} {:>9}'.format(url, score, 'no data'))
+            continue
+        reqs, successes, throttled, latency, last_code, updated = row
+        age = now - updated
+        print('{:<36} {:>6.3f} {:>9.1f} {:>8.1f} {:>10.1f} {:>8.2f}s {:>5}'.format(
+            url, score, _decay(reqs, age), _decay(successes, age), _decay(throttled, age),
+            latency, str(last_code)))
+
+
+def fetch_nitter_page(session, path, validators=None, stream=False, validators_url=None):
+    """
+    Download a page from the healthiest nitter instance, failing over to the next ones
+    :param session: requests session used to download the page
+    :param path: path of the page on the nitter instance (starting with '/')
+    :param validators: dictionary of conditional request headers (If-None-Match, If-Modified-Since)
+                       of a cached copy of the page. None if there is no cached copy
+    :param stream: if True, only the headers are read. The caller reads the body from
+                   response.raw and closes the response
+    :param validators_url: nitter url of the instance that delivered the cached copy. It is tried
+                           first and is the only one the validators are sent to, as other instances
+                           cannot match them
+    :return: tuple (nitter url, response). The status of the response is 304 if the cached copy
+             is still valid. (None, None) if no instance delivered the page
+    """
+    headers = {'Cookie': NITTER_COOKIES}
+    if USE_AUTH:
+        headers.update({'Authorization' : basic_auth("root", "hunter2")})
+
+    # The sort is stable: the other instances stay in order of health
+    ranking = rank_nitter_instances()
+    ranking.sort(key=lambda r: r[0] != validators_url)
+
+    for attempt, (nitter_url, score, row) in enumerate(ranking[:NITTER_MAX_ATTEMPTS]):
+        if attempt > 0:
+            count_metric('nitter_failovers')
+        url = nitter_url + path
+        request_headers = headers
+        if validators and nitter_url == validators_url:
+            request_headers = {**headers, **validators}
+        start = time.time()
         try:
-            toot = mastodon.status_post(
-                tweet['tweet_text'], media_ids=media_ids)
-        except MastodonError as me:
-            logging.error(
-                'posting ' + tweet['tweet_text'] + ' to ' + TOML['config']['mastodon_instance'] + ' Failed')
-            logging.error(me)
+            with timed_stage('nitter_fetch'):
+                page = session.get(url, headers=request_headers, timeout=HTTPS_REQ_TIMEOUT, stream=stream)
+        except requests.exceptions.ConnectionError:
+            logging.error('Host did not respond when trying to download ' + url)
+            record_nitter_result(nitter_url, None, HTTPS_REQ_TIMEOUT)
+            continue
+        except requests.exceptions.Timeout:
+            logging.error(nitter_url + ' took too long to respond')
+            record_nitter_result(nitter_url, None, HTTPS_REQ_TIMEOUT)
+            continue
+        except requests.exceptions.RequestException as e:
+            logging.error('Could not download ' + url + ': ' + repr(e))
+            record_nitter_result(nitter_url, None, time.time() - start)
+            continue
 
-    except MastodonError as me:
-        logging.error('posting ' + tweet['tweet_text'] + ' to ' +
-                      TOML['config']['mastodon_instance'] + ' Failed')
-        logging.error(me)
+        record_nitter_result(nitter_url, page.status_code, time.time() - start)
+        if not stream:
+            count_metric('bytes_downloaded', len(page.content))
 
-    else:
-        logging.debug('Tweet %s posted on %s',
-                      tweet['tweet_id'], TOML['config']['mastodon_user'])
+        # Verify that download worked
+        if page.status_code not in (200, 304):
+            logging.error('The Nitter page did not download correctly from ' + url + ' (' + str(
+                page.status_code) + ')')
+            page.close()
+            continue
+
+        logging.debug('Nitter page downloaded successfully from ' + url)
+        return nitter_url, page
+
+    return None, None
 
-    # Cleanup downloaded video files
+
+def get_preview_image(session, link_url):
+    """
+    Get the picture referenced by the "twitter:image" meta tag of a web page
+    Results are kept in the URL cache, including pages without picture
+    :param session: HTTP client returned by build_session()
+    :param link_url: url of the web page
+    :return: url of the picture. None if there is none
+    """
+    cached = url_cache_get(link_url, 'preview')
+    if cached is not None:
+        return cached if cached != '' else None
+
+    image_url = None
     try:
-        shutil.rmtree('./output')
-    except FileNotFoundError:  # The directory does not exist
-        pass
+        with timed_stage('preview_fetch'):
+            r = session.get(link_url, timeout=HTTPS_REQ_TIMEOUT)
+        if r.status_code != 200:
+            return None
+        # Matches the first instance of either twitter:image or twitter:image:src meta tag
+        match = re.search(
+            r'<meta name="twitter:image(?:|:src)" content="(.+?)".*?>', r.text)
+        if match is not None:
+            # Remove HTML-safe encoding from URL if any
+            image_url = match.group(1).replace('&amp;', '&')
+    # Give up if anything goes wrong
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ContentDecodingError,
+            requests.exceptions.TooManyRedirects,
+            requests.exceptions.MissingSchema):
+        return None
+    else:
+        logging.debug(
+            "downloaded twitter:image from linked page")
+
+    url_cache_put(link_url, 'preview', image_url if image_url is not None else '')
+
+    return image_url
+
+
+def parse_main_tweet(html):
+    """
+    Parse the main tweet of a nitter status page with the configured html_parser
+    The page is sliced around the main tweet before parsing and a strainer keeps
+    only the main-tweet subtree, so the navigation and replies are never built
+    :param html: text of nitter status page
+    :return: soup of 'div' tag of class main-tweet. None if not found
+    """
+    # Skip everything before the main tweet and from the replies onwards
+    start = html.find('<div class="main-tweet"')
+    if start != -1:
+        end = html.find('class="replies"', start)
+        if end != -1:
+            end = html.rfind('<', start, end)
+        html = html[start:end] if end != -1 else html[start:]
+
+    strainer = SoupStrainer('div', class_='main-tweet')
+    soup = BeautifulSoup(html, TOML['options']['html_parser'], parse_only=strainer)
+
+    return soup.find('div', class_='main-tweet')
+
+
+def parse_thread(html, author):
+    """
+    Parse the main tweet of a nitter status page and the tweets of its author that follow it
+    They are the author's tweets after the main tweet and the replies of the author that
+    start the first conversation below it. The page is read from the main tweet onwards
+    :param html: text of nitter status page
+    :param author: account of author of the main tweet
+    :return: list of soups of 'div' tags of class timeline-item, main tweet first.
+             Empty if the main tweet was not found
+    """
+    start = html.find('<div class="main-tweet"')
+    if start != -1:
+        html = html[start:]
+
+    # While parsing, the strainer sees the raw class attribute (e.g. "after-tweet thread-line")
+    def thread_part(value):
+        if value is None:
+            return False
+        classes = value.split() if isinstance(value, str) else value
+        return not {'main-tweet', 'after-tweet', 'replies'}.isdisjoint(classes)
+
+    strainer = SoupStrainer('div', class_=thread_part)
+    soup = BeautifulSoup(html, TOML['options']['html_parser'], parse_only=strainer)
+
+    main_tweet = soup.find('div', class_='main-tweet')
+    if main_tweet is None:
+        return []
+    statuses = [main_tweet.find('div', class_='timeline-item')]
+
+    def by_author(status):
+        username = status.get('data-username')
+        if username is None:
+            username_class = status.find('a', class_='username')
+            username = username_class.get('title', '').lstrip('@') if username_class is not None else ''
+        return username.lower() == author.lower() and status.find('a', class_='tweet-link') is not None
+
+    # Tweets following the main tweet in the thread, then replies of the author
+    after_tweet = soup.find('div', class_='after-tweet')
+    containers = [after_tweet] if after_tweet is not None else []
+    replies = soup.find('div', class_='replies')
+    if replies is not None:
+        first_reply = replies.find('div', class_='reply')
+        if first_reply is not None:
+            containers.append(first_reply)
+
+    for container in containers:
+        for status in container.find_all('div', class_='timeline-item'):
+            if not by_author(status):
+                return statuses
+            statuses.append(status)
+
+    return statuses
+
+
+def find_thread_parent(html, author):
+    """
+    Find the tweet of the author that the main tweet of a nitter status page continues
+    It is the last tweet shown before the main tweet in the thread
+    :param html: text of nitter status page
+    :param author: account of author of the main tweet
+    :return: id of the tweet. None if the main tweet does not continue a thread of the author
+    """
+    start = html.find('<div class="before-tweet')
+    end = html.find('<div class="main-tweet"')
+    if start == -1 or end < start:
+        return None
+
+    links = TWEET_LINK_RE.findall(html, start, end)
+    if not links or links[-1][0].lower() != author.lower():
+        return None
+    return links[-1][1]
+
+
+def scan_timeline(html, twitter_account, mark):
+    """
+    Find the statuses of the account that are newer than the mark in the page of its timeline
+    The raw page is scanned item by item, most recent first, with regular expressions only.
+    Pinned tweets and retweets are ignored. Scanning stops at the first status that is not
+    newer than the mark
+    :param html: text of nitter timeline page
+    :param twitter_account: account of the timeline
+    :param mark: id of most recent status already processed. None to take all statuses
+    :return: list of ids of new statuses, most recent first
+    """
+    starts = [m.start() for m in TIMELINE_ITEM_RE.finditer(html)]
+    new_ids = []
+    for start, end in zip(starts, starts[1:] + [len(html)]):
+        item = html[start:end]
+        link = TWEET_LINK_RE.search(item)
+        if link is None:  # e.g. unavailable tweet
+            continue
+        count_metric('timeline_items_scanned')
+
+        # Pinned tweets are out of order. Retweets link to the status of their author
+        if 'class="pinned"' in item or 'class="retweet-header"' in item \
+                or link.group(1).lower() != twitter_account.lower():
+            continue
+
+        status_id = link.group(2)
+        if mark is not None and int(status_id) <= int(mark):
+            break
+        if status_id not in new_ids:  # Tweets of a thread can appear twice
+            new_ids.append(status_id)
+
+    return new_ids
+
+
+def read_rss_timeline(session, twitter_account, mark, max_items):
+    """
+    Read the RSS feed of the nitter timeline of an account up to the mark
+    The feed is parsed incrementally while it is downloaded and the download stops at the
+    first item that is not newer than the mark, or when enough new items were read.
+    Retweets are ignored.
+    :param session: requests session used to download the feed
+    :param twitter_account: account of the timeline
+    :param mark: id of most recent status already processed. None to take all statuses
+    :param max_items: maximum number of new items to read
+    :return: tuple (display name of author, list of items, most recent first). An item is
+             a dictionary with the 'status_id', 'pub_date' and 'description' of the status.
+             None if the feed could not be downloaded or parsed
+    """
+    import xml.etree.ElementTree as ET
+
+    nitter_url, feed = fetch_nitter_page(session, '/' + twitter_account + '/rss', stream=True)
+    if feed is None:
+        return None
+
+    author = None
+    items = []
+    with feed, timed_stage('timeline_scan'):
+        feed.raw.decode_content = True
+        in_item = False
+        try:
+            for event, elem in ET.iterparse(feed.raw, events=('start', 'end')):
+                if event == 'start':
+                    in_item = in_item or elem.tag == 'item'
+                    continue
+
+                # Title of channel is "<display name> / @<account>"
+                if elem.tag == 'title' and not in_item and author is None:
+                    author = (elem.text or '').rsplit(' / @', 1)[0]
+                    continue
+                if elem.tag != 'item':
+                    continue
+
+                in_item = False
+                count_metric('timeline_items_scanned')
+                link = RSS_LINK_RE.search(elem.findtext('link', ''))
+                creator = elem.findtext(RSS_CREATOR_TAG, '').lstrip('@')
+                if link is not None and link.group(1).lower() == twitter_account.lower() \
+                        and creator.lower() == twitter_account.lower():
+                    status_id = link.group(2)
+                    if mark is not None and int(status_id) <= int(mark):
+                        break
+                    if status_id not in [item['status_id'] for item in items]:
+                        items.append({
+                            'status_id': status_id,
+                            'pub_date': elem.findtext('pubDate', ''),
+                            'description': elem.findtext('description', ''),
+                        })
+                        if len(items) >= max_items:
+                            break
+
+                # Items already read are not needed any more
+                elem.clear()
+        except ET.ParseError as e:
+            logging.error('Could not parse RSS feed of ' + twitter_account + ' from ' + nitter_url + ': ' + str(e))
+            return None
+
+        count_metric('bytes_downloaded', feed.raw.tell())
+
+    return author or twitter_account, items
+
+
+def rss_item_tweet(session, twitter_account, author, item):
+    """
+    Build the dictionary of a tweet from an item of the RSS feed of its author
+    The text and pictures of the tweet are taken from the description of the item.
+    :param session: requests session used to download linked pages
+    :param twitter_account: account of the author
+    :param author: display name of the author
+    :param item: item returned by read_rss_timeline()
+    :return: dictionary with content of tweet. None if the tweet has content that the feed
+             does not carry (video, GIF, quoted tweet, ...) and must be read from its page
+    """
+    import email.utils
+
+    soup = BeautifulSoup(item['description'], TOML['options']['html_parser'])
+
+    # The text is in the first paragraph. Anything else (quoted tweet, poll, ...) is missing from the feed
+    paragraphs = soup.find_all('p')
+    if len(paragraphs) != 1 or soup.find(['video', 'blockquote']) is not None:
+        return None
+    pictures = [img.get('src', '') for img in soup.find_all('img')]
+    if any(thumb in picture for picture in pictures for thumb in RSS_VIDEO_THUMBS):
+        return None
+
+    try:
+        timestamp = email.utils.parsedate_to_datetime(item['pub_date']).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+    # Line breaks are followed by a new line in the feed
+    for br in paragraphs[0].find_all('br'):
+        br.decompose()
+    tweet_text = process_media_body(session, paragraphs[0].children)
+
+    # Same full size pictures as on the status page
+    photos = [picture.replace('/pic/media', '/pic/orig/media') for picture in pictures if picture != '']
+
+    status_url = 'https://x.com/' + twitter_account + '/status/' + item['status_id']
+    tweet_text = finish_tweet_text(session, tweet_text, photos, status_url)
+
+    return {
+        "author": author,
+        "author_account": twitter_account,
+        "timestamp": timestamp,
+        "tweet_id": item['status_id'],
+        "tweet_text": tweet_text,
+        "video": [],
+        "photos": photos,
+    }
+
+
+def poll_rss_timeline(session, twitter_account, mark):
+    """
+    List the new statuses of an account from the RSS feed of its nitter timeline
+    :param session: requests session used to download the feed
+    :param twitter_account: account whose timeline is polled
+    :param mark: id of most recent status already processed. None to take all statuses
+    :return: tuple (list of ids of new statuses, most recent first, dictionary of the tweets
+             built from the feed by status id). Statuses missing from the dictionary are read
+             from their page. None if the feed could not be read
+    """
+    feed = read_rss_timeline(session, twitter_account, mark, TOML['options']['timeline_max_statuses'])
+    if feed is None:
+        return None
+
+    author, items = feed
+    tweets = {}
+    for item in items:
+        tweet = rss_item_tweet(session, twitter_account, author, item)
+        if tweet is None:
+            logging.debug('Status ' + item['status_id'] + ' will be read from its page')
+            count_metric('rss_fallbacks')
+        else:
+            tweets[item['status_id']] = tweet
+
+    return [item['status_id'] for item in items], tweets
+
+
+def timeline_destinations():
+    """
+    :return: list of destinations for which timeline marks are kept. Marks of
+             exports are kept for an empty Mastodon account, even if accounts are
+             configured, so that exporting does not skip statuses for them
+    """
+    if TOML['options']['export_json_path'] != '' or not TOML['destinations']:
+        return [{'mastodon_instance': '', 'mastodon_user': ''}]
+    return TOML['destinations']
+
+
+def poll_timeline(session, twitter_account):
+    """
+    Download the nitter timeline of an account and list the statuses that are newer
+    than its timeline mark
+    With timeline_source = "rss", the RSS feed of the timeline is read instead of its page
+    and the tweets are built from the feed when it carries all their content
+    :param session: requests session used to download the page
+    :param twitter_account: account whose timeline is polled
+    :return: tuple (list of status URLs, oldest first, at most timeline_max_statuses,
+             dictionary of tweets already built by status URL).
+             None if the timeline could not be downloaded
+    """
+    # A status is new if one of the destinations has not processed it yet
+    marks = [get_timeline_mark(twitter_account, destination) for destination in timeline_destinations()]
+    mark = None if None in marks else min(marks, key=int)
+
+    polled = None
+    # Threads are only on the pages of the statuses
+    if TOML['options']['timeline_source'] == 'rss' and not TOML['options']['mirror_thread']:
+        polled = poll_rss_timeline(session, twitter_account, mark)
+        if polled is None:
+            logging.warning('Could not read RSS feed of ' + twitter_account + '. Reading its timeline page')
+
+    if polled is None:
+        nitter_url, page = fetch_nitter_page(session, '/' + twitter_account)
+        if page is None:
+            logging.error('No nitter instance delivered the timeline of ' + twitter_account)
+            return None
+
+        with timed_stage('timeline_scan'):
+            polled = scan_timeline(page.text, twitter_account, mark), {}
+
+    new_ids, tweets = polled
+    logging.info('%d new statuses in timeline of %s since %s', len(new_ids), twitter_account, str(mark))
+    count_metric('timeline_new_statuses', len(new_ids))
+
+    # Most recent first on the page. Keep the most recent ones and post them in order
+    new_ids = new_ids[:TOML['options']['timeline_max_statuses']]
+    statuses = []
+    built = {}
+    for status_id in reversed(new_ids):
+        status_url = 'https://x.com/' + twitter_account + '/status/' + status_id
+        statuses.append(status_url)
+        if status_id in tweets:
+            built[status_url] = tweets[status_id]
+
+    return statuses, built
+
+
+def parse_status_url(status_url):
+    """
+    Extract author and id of a tweet from its URL
+    :param status_url: full URL of the tweet
+    :return: tuple (author account, status id)
+    """
+    url = clean_url(status_url)
+
+    status_id = url.split("/")[-1].split("?")[0]
+    status_author = url.split("x.com/")[-1].split("/")[0]
+
+    return status_author, status_id
+
+
+def finish_tweet_text(session, tweet_text, photos, full_status_url):
+    """
+    Add the footers to the text of a tweet and a preview picture of its first link if it has no media
+    :param session: requests session used to download linked pages
+    :param tweet_text: text of tweet
+    :param photos: list of picture URLs of tweet. The preview picture is appended to it
+    :param full_status_url: cleaned URL of the tweet
+    :return: text of tweet with footers
+    """
+    # Add custom footer from config file
+    if TOML['options']['footer'] != '':
+        tweet_text += '\n\n' + TOML['options']['footer']
+
+    # Add footer with link to original tweet
+    if TOML['options']['remove_original_tweet_ref'] == False:
+        if TOML['options']['footer'] != '':
+            tweet_text += '\nOriginal tweet: ' + \
+                substitute_source(full_status_url)
+        else:
+            tweet_text += '\n\nOriginal tweet: ' + \
+                substitute_source(full_status_url)
+
+    # If no media was specifically added in the tweet, try to get the first picture
+    # with "twitter:image" meta tag in first linked page in tweet text
+    if not photos:
+        m = re.search(r"http[^ \n\xa0]*", tweet_text)
+        if m is not None:
+            link_url = m.group(0)
+            if link_url.endswith(".html"):  # Only process a web page
+                image_url = get_preview_image(session, link_url)
+                if image_url is not None:
+                    photos.append(image_url)
+
+    return tweet_text
+
+
+def extract_tweet(session, nitter_url, status, status_author, status_id, status_url):
+    """
+    Extract the content of a tweet from its soup
+    Videos are downloaded on the file system.
+    :param session: requests session used to download media and linked pages
+    :param nitter_url: url of the nitter instance that delivered the page
+    :param status: soup of 'div' tag of class timeline-item of the tweet
+    :param status_author: account of author of tweet
+    :param status_id: id of tweet
+    :param status_url: full URL of the tweet
+    :return: dictionary with content of tweet. None if its video could not be downloaded
+    """
+    # **********************************************************
+    # Process each tweet and generate dictionary
+    # with data ready to be posted on Mastodon
+    # **********************************************************
+
+    # Extract time stamp
+    time_string = status.find('span', class_='tweet-date').a.get('title')
+    try:
+        timestamp = datetime.strptime(
+            time_string, '%d/%m/%Y, %H:%M:%S').timestamp()
+    except:
+        # Dec 21, 2021 · 12:00 PM UTC
+        timestamp = datetime.strptime(
+            time_string, '%b %d, %Y · %I:%M %p %Z').timestamp()
+
+    # extract author
+    author = status.find('a', class_='fullname').get('title')
+
+    # Extract user name
+    author_account = status_author
+
+    # Extract URL of full status page (for video download)
+    full_status_url = clean_url(status_url)
+
+    # Initialize containers
+    tweet_text = ''
+    photos = []
+
+    # Add prefix if the tweet is a reply-to
+    # Only consider item of class 'replying-to' that is a direct child
+    # of class 'tweet-body' in status. Others can be in a quoted tweet.
+    #replying_to_class = status.select("div.tweet-body > div.replying-to")
+    # if len(replying_to_class) != 0:
+    #    tweet_text += 'Replying to ' + \
+    #        replying_to_class[0].a.get_text() + '\n\n'
+
+    # extract iterator over tweet text contents
+    tt_iter = status.find(
+        'div', class_='tweet-content media-body').children
+
+    # Process text of tweet
+    tweet_text += process_media_body(session, tt_iter)
+
+    # Process quote: append link to tweet_text
+    quote_div = status.find('a', class_='quote-link')
+    if quote_div is not None:
+        tweet_text += "\n\nRE: " + substitute_source('\n\nhttps://x.com' +
+                                        quote_div.get('href').strip('#m'))
+    # Process card : extract image if necessary
+    card_class = status.find('a', class_='card-container')
+    if card_class is not None:
+        photos.extend(process_card(nitter_url, card_class))
+
+    # Process attachment: capture image or .mp4 url or download twitter video
+    attachments_class = status.find('div', class_='attachments')
+    if attachments_class is not None:
+        try:
+            pics, vid_in_tweet = process_attachments(session, nitter_url,
+                                                     attachments_class,
+                                                     status_id, author_account
+                                                     )
+        except (requests.exceptions.RequestException, OSError):
+            # Video could not be downloaded. Do not post an incomplete tweet
+            return None
+        photos.extend(pics)
+
+    tweet_text = finish_tweet_text(session, tweet_text, photos, full_status_url)
+
+    # Check if video was downloaded
+    video_file = []
+
+    video_path = Path('./output') / status_id
+    if video_path.exists():
+        # list video files (including video of GIF animation in sub-directory)
+        # in the order of the tweet: 0.mp4, 1.mp4, ... then gif_video.mp4
+        video_file_list = sorted(video_path.rglob('*.mp4'),
+                                 key=lambda v: (not v.stem.isdigit(), int(v.stem) if v.stem.isdigit() else 0, str(v)))
+        for video in video_file_list:
+            video_file.append(video.absolute().as_posix())
+
+    # Add dictionary with content of tweet to list
+    tweet = {
+        "author": author,
+        "author_account": author_account,
+        "timestamp": timestamp,
+        "tweet_id": status_id,
+        "tweet_text": tweet_text,
+        "video": video_file,
+        "photos": photos,
+    }
+
+    return tweet
+
+
+def process_status(session, status_url, thread_locks=None):
+    """
+    Download the nitter page of a status and extract its content
+    Videos are downloaded on the file system.
+    :param session: requests session used to download the page
+    :param status_url: full URL of the tweet
+    :param thread_locks: ExitStack in which the status locks of the following tweets of the
+                         thread are taken before their videos are downloaded. The caller keeps
+                         them until it has removed their files. None to take no lock
+    :return: dictionary with content of tweet. With mirror_thread, the following tweets
+             of the author found on the page are in a list under the 'thread' key, and the
+             id of the tweet of the author it continues under 'thread_parent' (None if it
+             starts the thread). None if it could not be processed
+    """
+    status_author, status_id = parse_status_url(status_url)
+
+    locked = set()
+
+    def lock_thread(reply_ids):
+        # Jobs take locks in increasing id order only, so they cannot wait for each other in a cycle
+        reply_ids = [reply_id for reply_id in reply_ids
+                     if _status_key(reply_id) > _status_key(status_id) and reply_id not in locked]
+        if thread_locks is not None and reply_ids:
+            thread_locks.enter_context(status_lock(*reply_ids))
+            locked.update(reply_ids)
+
+    logging.debug('processing tweet %s', status_id)
+
+    # Use the cached page without network access if it is fresh, otherwise revalidate it
+    cached = page_cache_get(status_author, status_id)
+    if cached is not None and time.time() - cached['fetched'] < TOML['options']['page_cache_fresh_minutes'] * 60:
+        logging.debug('Using cached page of status ' + status_id)
+        count_metric('page_cache_hits')
+        nitter_url, twit_html = cached['nitter_url'], cached['html']
+    else:
+        validators = {}
+        if cached is not None and cached['etag'] is not None:
+            validators['If-None-Match'] = cached['etag']
+        if cached is not None and cached['last_modified'] is not None:
+            validators['If-Modified-Since'] = cached['last_modified']
+
+        # Download twitter page
+        nitter_url, twit_page = fetch_nitter_page(session, '/' + status_author + '/status/' + status_id,
+                                                  validators, validators_url=None if cached is None else cached['nitter_url'])
+        if twit_page is None:
+            logging.fatal('No nitter instance delivered status ' + status_id + '. Aborting')
+            return None
+
+        if twit_page.status_code == 304 and cached is not None:
+            logging.debug('Cached page of status ' + status_id + ' is still valid')
+            count_metric('page_cache_revalidated')
+            page_cache_touch(status_author, status_id)
+            # Links of the cached page point to the instance that delivered it
+            nitter_url, twit_html = cached['nitter_url'], cached['html']
+        else:
+            count_metric('page_cache_misses')
+            page_cache_put(status_author, status_id, nitter_url, twit_page)
+            twit_html = twit_page.text
+            cached = None
+
+    # Reuse the tweet extracted from the same page unless its videos were cleaned up
+    if cached is not None and cached['tweet'] is not None:
+        lock_thread([reply['tweet_id'] for reply in cached['tweet'].get('thread', [])])
+    if cached is not None and cached['tweet'] is not None \
+            and all(os.path.isfile(video) for video in cached['tweet']['video']) \
+            and all(os.path.isfile(video) for reply in cached['tweet'].get('thread', []) for video in reply['video']):
+        logging.debug('Using tweet extracted from cached page of status ' + status_id)
+        count_metric('tweet_cache_hits')
+        return cached['tweet']
+
+    # DEBUG: Save page to file
+    # of = open(toml['config']['twitter_account'] + '.html', 'w')
+    # of.write(twit_html)
+    # of.close()
+
+    # Make soup of the main tweet only, or of the thread
+    with timed_stage('parse'):
+        if TOML['options']['mirror_thread']:
+            statuses = parse_thread(twit_html, status_author)
+        else:
+            main_tweet = parse_main_tweet(twit_html)
+            statuses = [] if main_tweet is None else [main_tweet.find('div', class_='timeline-item')]
+    if not statuses:
+        logging.error('No tweet found on page of status ' + status_id)
+        return None
+
+    tweet = extract_tweet(session, nitter_url, statuses[0], status_author, status_id, status_url)
+    if tweet is None:
+        return None
+
+    if TOML['options']['mirror_thread']:
+        tweet['thread_parent'] = find_thread_parent(twit_html, status_author)
+
+        # Following tweets of the author, up to the first one that cannot be extracted
+        reply_ids = [status.find('a', class_='tweet-link').get('href').split('/')[-1].split('#')[0]
+                     for status in statuses[1:]]
+        lock_thread(reply_ids)
+        tweet['thread'] = []
+        for status, reply_id in zip(statuses[1:], reply_ids):
+            reply = extract_tweet(session, nitter_url, status, status_author, reply_id,
+                                  'https://x.com/' + status_author + '/status/' + reply_id)
+            if reply is None:
+                break
+            tweet['thread'].append(reply)
+        logging.debug('Found %d tweets of the author after status %s', len(tweet['thread']), status_id)
+
+    page_cache_put_tweet(status_author, status_id, tweet)
+
+    return tweet
+
+
+def fetch_instance_capabilities(session, mastodon):
+    """
+    Get the limits of the Mastodon instance from its configuration
+    Values missing from the configuration (older versions, other software) are the Mastodon defaults
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :return: dictionary of capabilities
+    :raise requests.exceptions.RequestException: if the configuration could not be downloaded
+    """
+    r = session.get(mastodon.api_base_url + '/api/v1/instance', timeout=HTTPS_REQ_TIMEOUT)
+    r.raise_for_status()
+    info = r.json()
+
+    configuration = info.get('configuration') or {}
+    statuses = configuration.get('statuses') or {}
+    media = configuration.get('media_attachments') or {}
+
+    caps = dict(DEFAULT_CAPABILITIES)
+    # Pleroma and Akkoma advertise max_toot_chars
+    caps['max_characters'] = info.get('max_toot_chars', caps['max_characters'])
+    for section in (statuses, media):
+        for key in caps.keys():
+            if key in section:
+                caps[key] = section[key]
+
+    return caps
+
+
+def get_instance_capabilities(session, mastodon):
+    """
+    Get the capabilities of the Mastodon instance, from the cache file stored next
+    to the .secret files if it is less than CAPABILITIES_TTL seconds old
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :return: dictionary of capabilities
+    """
+    import json
+
+    instance = urlparse(mastodon.api_base_url).netloc
+    with INSTANCE_CAPABILITIES_LOCK:
+        caps = INSTANCE_CAPABILITIES.get(instance)
+        if caps is not None and time.time() - caps['fetched'] < CAPABILITIES_TTL:
+            return caps
+
+        cache_file = instance + '.capabilities'
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                caps = json.load(f)
+            if time.time() - caps['fetched'] >= CAPABILITIES_TTL:
+                caps = None
+        except (FileNotFoundError, ValueError, KeyError):
+            caps = None
+
+        if caps is None:
+            try:
+                caps = fetch_instance_capabilities(session, mastodon)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.warning('Could not get configuration of ' + instance + '. Using default limits')
+                logging.warning(e)
+                caps = dict(DEFAULT_CAPABILITIES, fetched=time.time())
+            else:
+                caps['fetched'] = time.time()
+                with open(cache_file, 'w', encoding='utf-8') as f:
+                    json.dump(caps, f, indent=2)
+                logging.debug('Saved capabilities of ' + instance + ' in ' + cache_file)
+
+        INSTANCE_CAPABILITIES[instance] = caps
+
+    return caps
+
+
+def trim_text(text, caps):
+    """
+    Shorten the text of a toot to the character limit of the instance
+    URLs count for characters_reserved_per_url characters, as on Mastodon.
+    The footer and the reference to the original tweet are kept
+    :param text: text of toot
+    :param caps: capabilities of the instance
+    :return: text that fits in a toot
+    """
+    url_pattern = re.compile(r'https?://[^\s]+')
+
+    def length(t):
+        return len(url_pattern.sub('x' * caps['characters_reserved_per_url'], t))
+
+    if length(text) <= caps['max_characters']:
+        return text
+
+    # Keep the footer intact
+    footer_start = -1
+    if TOML['options']['footer'] != '':
+        footer_start = text.rfind('\n\n' + TOML['options']['footer'])
+    if footer_start == -1:
+        footer_start = text.rfind('\n\nOriginal tweet: ')
+    if footer_start == -1:
+        footer_start = len(text)
+    body, footer = text[:footer_start], text[footer_start:]
+
+    # Find the longest beginning of the body that fits
+    budget = caps['max_characters'] - length('…' + footer)
+    low, high = 0, len(body)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if length(body[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+
+    # Cut it after the last complete word, unless there is no space or newline close to the
+    # limit, e.g. in Chinese or Japanese text or in a long URL
+    cut = max(body.rfind(' ', 0, low + 1), body.rfind('\n', 0, low + 1))
+    if low < len(body) and cut >= 0 and low - cut <= TRIM_MAX_WORD_LENGTH:
+        low = cut
+    body = body[:low]
+
+    trimmed = body.rstrip() + '…' + footer
+    logging.warning('Text of toot trimmed to ' + str(caps['max_characters']) + ' characters')
+    return trimmed
+
+
+def check_media(caps, mime_type, size):
+    """
+    Check a media against the limits of the instance before it is uploaded
+    :param caps: capabilities of the instance
+    :param mime_type: mime type of the media
+    :param size: size of the media in bytes. None if unknown
+    :return: True if the instance should accept the media
+    """
+    mime_type = mime_type.split(';')[0].strip()
+    if caps['supported_mime_types'] is not None and mime_type not in caps['supported_mime_types']:
+        logging.warning('Media type ' + mime_type + ' not supported by instance. Not uploading')
+        return False
+
+    if mime_type.startswith('video/') or mime_type == 'image/gif':
+        limit = caps['video_size_limit']
+    else:
+        limit = caps['image_size_limit']
+    if size is not None and size > limit:
+        logging.warning('Media of ' + str(size) + ' bytes exceeds limit of instance (' +
+                        str(limit) + '). Not uploading')
+        return False
+
+    return True
+
+
+def _multipart_body(boundary, file_name, mime_type, chunks):
+    """
+    private function
+    Generate a multipart/form-data body with a single file field from an iterator of chunks
+    :param boundary: multipart boundary
+    :param file_name: name given to the file
+    :param mime_type: mime type of the file
+    :param chunks: iterator over the content of the file
+    :return: generator of body parts
+    """
+    yield ('--' + boundary + '\r\n'
+           + 'Content-Disposition: form-data; name="file"; filename="' + file_name + '"\r\n'
+           + 'Content-Type: ' + mime_type + '\r\n\r\n').encode('utf-8')
+    for chunk in chunks:
+        yield chunk
+    yield ('\r\n--' + boundary + '--\r\n').encode('utf-8')
+
+
+def stream_media_post(session, mastodon, chunks, file_name, mime_type):
+    """
+    Upload a media to Mastodon with a chunked request body
+    Chunks are sent as they are produced so the media is never held entirely in memory
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :param chunks: iterator over the content of the media
+    :param file_name: name given to the media
+    :param mime_type: mime type of the media
+    :return: media dict returned by the Mastodon API
+    :raise MastodonAPIError: if the instance refused the media
+    """
+    from mastodon import MastodonAPIError
+
+    boundary = 'twoot' + os.urandom(16).hex()
+    headers = {
+        'Authorization': 'Bearer ' + mastodon.access_token,
+        'Content-Type': 'multipart/form-data; boundary=' + boundary,
+    }
+
+    # A generator as data makes requests use chunked transfer encoding
+    with timed_stage('media_post'):
+        response = session.post(mastodon.api_base_url + '/api/v2/media', headers=headers,
+                                 data=_multipart_body(boundary, file_name, mime_type, chunks),
+                                 timeout=HTTPS_REQ_TIMEOUT * 6)
+    count_metric('media_uploads')
+    if response.status_code not in (200, 202):
+        raise MastodonAPIError('Mastodon API returned error', response.status_code,
+                               response.reason, response.text)
+
+    return response.json()
+
+
+def download_photo(session, photo, staged):
+    """
+    Download a picture into a file
+    :param session: HTTP client returned by build_session()
+    :param photo: url of picture
+    :param staged: binary file object the picture is written to
+    :return: mime type of the picture. None if it could not be downloaded
+    """
+    try:
+        with host_slot(photo), timed_stage('media_download'), \
+                session.get(photo, stream=True, timeout=HTTPS_REQ_TIMEOUT) as media:
+            if not media:
+                return None
+            for chunk in media.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                staged.write(chunk)
+                count_metric('bytes_downloaded', len(chunk))
+            return media.headers['content-type']
+
+    except:  # Picture cannot be downloaded for any reason
+        return None
+
+
+def stage_photos(session, tweet):
+    """
+    Download the pictures of a tweet once for all the destinations it is posted on
+    They are saved next to its videos and removed with them by cleanup_output()
+    :param session: HTTP client returned by build_session()
+    :param tweet: dictionary with content of tweet built by process_status()
+    :return: copy of tweet whose photos are the paths of the downloaded files. Pictures
+             that could not be downloaded are left as URLs. With the media cache, the
+             pictures are only added to the cache and the photos are left unchanged
+    """
+    import mimetypes
+
+    if TOML['options']['media_cache_max_mb'] > 0 and not TOML['options']['stream_media']:
+        with ThreadPoolExecutor(max_workers=TOML['options']['media_workers']) as pool:
+            list(pool.map(lambda photo: media_cache_get(session, photo), tweet['photos']))
+        return dict(tweet)
+
+    photo_dir = Path('./output') / tweet['tweet_id'] / 'photos'
+    photo_dir.mkdir(parents=True, exist_ok=True)
+
+    def stage(index, photo):
+        with tempfile.NamedTemporaryFile(dir=photo_dir, delete=False) as staged:
+            mime_type = download_photo(session, photo, staged)
+        extension = mimetypes.guess_extension(mime_type.split(';')[0].strip()) if mime_type else None
+        if extension is None:
+            os.remove(staged.name)
+            return photo
+        # The mime type is found again from the extension when uploading
+        photo_path = photo_dir / (str(index) + extension)
+        os.replace(staged.name, photo_path)
+        return str(photo_path.absolute())
+
+    with ThreadPoolExecutor(max_workers=TOML['options']['media_workers']) as pool:
+        photos = list(pool.map(stage, range(len(tweet['photos'])), tweet['photos']))
+
+    return dict(tweet, photos=photos)
+
+
+def upload_photo(session, mastodon, photo, caps):
+    """
+    Download a picture and upload it to the Mastodon instance
+    With stream_media, downloaded chunks are piped into the upload request. Otherwise the
+    picture is taken from the media cache, and a copy uploaded earlier to the account and not
+    attached to any toot is reused. Without media cache the picture is staged in memory, or
+    on disk above media_spool_threshold
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :param photo: url of picture, or path of the picture downloaded by stage_photos()
+    :param caps: capabilities of the instance returned by get_instance_capabilities()
+    :return: media dict returned by the Mastodon API. None if the picture could not be transferred
+    """
+    import mimetypes
+    from mastodon import MastodonAPIError, MastodonIllegalArgumentError
+
+    file_name = os.path.basename(urlparse(photo).path) or 'photo'
+    digest = None
+
+    if os.path.isfile(photo):  # Already downloaded for several destinations
+        mime_type = mimetypes.guess_type(photo)[0]
+        staged = open(photo, 'rb')
+        staged.seek(0, os.SEEK_END)
+    elif TOML['options']['media_cache_max_mb'] > 0 and not TOML['options']['stream_media']:
+        cached = media_cache_get(session, photo)
+        if cached is None:
+            return None
+        cached_path, mime_type, digest = cached
+        try:
+            staged = open(cached_path, 'rb')
+        except OSError:  # Evicted by a concurrent job
+            return None
+        staged.seek(0, os.SEEK_END)
+    else:
+        try:
+            if TOML['options']['stream_media']:
+                logging.debug('streaming picture to Mastodon')
+                with host_slot(photo, mastodon.api_base_url), \
+                        session.get(photo, stream=True, timeout=HTTPS_REQ_TIMEOUT) as media:
+                    if not media:
+                        return None
+                    size = media.headers.get('content-length')
+                    if not check_media(caps, media.headers['content-type'],
+                                       int(size) if size is not None else None):
+                        return None
+                    media_posted = stream_media_post(
+                        session, mastodon, media.iter_content(chunk_size=MEDIA_CHUNK_SIZE),
+                        file_name, media.headers['content-type'])
+
+                return media_posted
+        except:  # Picture cannot be streamed for any reason
+            return None
+
+        # Download picture
+        logging.debug('downloading picture')
+        staged = tempfile.SpooledTemporaryFile(max_size=TOML['options']['media_spool_threshold'])
+        mime_type = download_photo(session, photo, staged)
+        if mime_type is None:
+            staged.close()
+            return None
+
+    if not check_media(caps, mime_type, staged.tell()):
+        staged.close()
+        return None
+
+    if digest is not None:
+        media_posted = media_id_claim(mastodon, digest)
+        if media_posted is not None:
+            staged.close()
+            return media_posted
+
+    # Upload picture to Mastodon instance
+    with staged:
+        staged.seek(0)
+        try:
+            logging.debug('uploading picture to Mastodon')
+            with host_slot(mastodon.api_base_url), timed_stage('media_post'):
+                count_metric('media_uploads')
+                media_posted = mastodon.media_post(
+                    staged, mime_type=mime_type, file_name=file_name)
+        except (MastodonAPIError, MastodonIllegalArgumentError,
+                TypeError):  # Media cannot be uploaded (invalid format, dead link, etc.)
+            return None
+
+    if digest is not None:
+        media_id_put(mastodon, digest, media_posted['id'])
+
+    return media_posted
+
+
+def _file_chunks(file_path):
+    """
+    private function
+    :param file_path: path of file to read
+    :return: generator of chunks of the file
+    """
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(MEDIA_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def probe_video(video_path):
+    """
+    Get the characteristics of a video with ffprobe
+    :param video_path: path of video file
+    :return: tuple (width, height, duration in seconds)
+    """
+    import json
+
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                          '-show_entries', 'stream=width,height:format=duration',
+                          '-of', 'json', video_path],
+                         capture_output=True, check=True, timeout=60)
+    info = json.loads(out.stdout)
+    stream = info['streams'][0]
+
+    return int(stream['width']), int(stream['height']), float(info['format'].get('duration', 0))
+
+
+def conform_cache_lookup(video_path, max_bytes, max_pixels):
+    """
+    Look up the result of a previous check of a video against size and resolution limits
+    Results are cached by content hash of the video and limits
+    :param video_path: path of video file
+    :param max_bytes: maximum size of video file
+    :param max_pixels: maximum number of pixels of a frame (width x height)
+    :return: tuple (key of the video in the cache, path of conformant video). The path is
+             video_path itself if the video already conforms and None if it was not checked yet
+    """
+    digest = hashlib.sha256()
+    with open(video_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    key = digest.hexdigest() + '-' + str(max_bytes) + '-' + str(max_pixels)
+
+    # Marker file for videos that were already checked and conform
+    conform_marker = os.path.join(CONFORM_CACHE_DIR, key + '.ok')
+    conformed_path = os.path.join(CONFORM_CACHE_DIR, key + '.mp4')
+    for cached in (conform_marker, conformed_path):
+        try:
+            # Refresh age of cache entry
+            os.utime(cached)
+        except FileNotFoundError:
+            continue
+        return key, video_path if cached == conform_marker else conformed_path
+
+    return key, None
+
+
+def conform_video(video_path, key, max_bytes, max_pixels, cache_dir):
+    """
+    Make a video conform to size and resolution limits, transcoding it only if needed
+    Runs in a worker process, for videos not found by conform_cache_lookup()
+    :param video_path: path of video file
+    :param key: key of the video in the cache returned by conform_cache_lookup()
+    :param max_bytes: maximum size of video file
+    :param max_pixels: maximum number of pixels of a frame (width x height)
+    :param cache_dir: directory where conformed videos are cached
+    :return: path of conformant video (video_path itself if it already conforms).
+             None if the video cannot be made conformant
+    """
+    conform_marker = os.path.join(cache_dir, key + '.ok')
+    conformed_path = os.path.join(cache_dir, key + '.mp4')
+
+    width, height, duration = probe_video(video_path)
+    size = os.path.getsize(video_path)
+    if size <= max_bytes and width * height <= max_pixels:
+        open(conform_marker, 'w').close()
+        return video_path
+
+    args = ['ffmpeg', '-y', '-v', 'error', '-i', video_path]
+    if width * height > max_pixels:
+        # Downscale keeping the aspect ratio. x264 requires even dimensions
+        ratio = math.sqrt(max_pixels / (width * height))
+        args += ['-vf', 'scale={w}:{h}'.format(w=int(width * ratio) // 2 * 2, h=int(height * ratio) // 2 * 2)]
+    if size > max_bytes and duration > 0:
+        # Leave 10% margin for the container and 128 kbps for the audio
+        bitrate = max(int(max_bytes * 8 * 0.9 / duration) - 128000, 100000)
+        args += ['-b:v', str(bitrate), '-maxrate', str(bitrate), '-bufsize', str(2 * bitrate)]
+    tmp_path = conformed_path + '.' + str(os.getpid()) + '.tmp.mp4'
+    args += ['-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac', '-b:a', '128k',
+             '-movflags', '+faststart', tmp_path]
+
+    try:
+        subprocess.run(args, capture_output=True, check=True, timeout=max(600, duration * 10))
+        if os.path.getsize(tmp_path) > max_bytes:
+            return None
+        os.replace(tmp_path, conformed_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return conformed_path
+
+
+def prune_conform_cache():
+    """
+    Delete the conformed videos that were not used for CONFORM_CACHE_DAYS
+    """
+    limit = time.time() - CONFORM_CACHE_DAYS * 86400
+    for cached in Path(CONFORM_CACHE_DIR).glob('*'):
+        try:
+            if cached.stat().st_mtime < limit:
+                cached.unlink()
+        except FileNotFoundError:
+            # Already deleted by another process
+            pass
+
+
+def conform_pool():
+    """
+    :return: pool of worker processes checking and transcoding videos, shared by all jobs
+             of the process. It is started when first needed
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    global CONFORM_POOL
+    with CONFORM_POOL_LOCK:
+        if CONFORM_POOL is None:
+            # Spawn workers: forking a process with running threads is not safe
+            CONFORM_POOL = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                               mp_context=multiprocessing.get_context('spawn'))
+    return CONFORM_POOL
+
+
+def conform_videos(video_paths, caps):
+    """
+    Check videos against video_max_bytes and video_max_pixels, or the lower limits of the
+    instance, before they are uploaded and transcode or downscale the ones that exceed them.
+    Videos that are not in the cache are processed in the pool of worker processes
+    :param video_paths: list of paths of video files
+    :param caps: capabilities of the instance returned by get_instance_capabilities()
+    :return: list of paths of videos to upload, in the same order. Videos that
+             cannot be made conformant are left out
+    """
+    if not video_paths:
+        return []
+
+    if shutil.which('ffprobe') is None or shutil.which('ffmpeg') is None:
+        logging.warning('ffprobe / ffmpeg not found. Uploading videos as downloaded')
+        return video_paths
+
+    os.makedirs(CONFORM_CACHE_DIR, exist_ok=True)
+    prune_conform_cache()
+
+    max_bytes = min(TOML['options']['video_max_bytes'], caps['video_size_limit'])
+    max_pixels = min(TOML['options']['video_max_pixels'], caps['video_matrix_limit'])
+
+    # Only the videos that were not checked before are sent to the worker processes
+    futures = []
+    for video_path in video_paths:
+        future = Future()
+        try:
+            key, path = conform_cache_lookup(video_path, max_bytes, max_pixels)
+        except OSError as e:
+            future.set_exception(e)
+        else:
+            if path is None:
+                future = conform_pool().submit(conform_video, video_path, key, max_bytes, max_pixels,
+                                               CONFORM_CACHE_DIR)
+            else:
+                future.set_result(path)
+        futures.append(future)
+
+    conformed = []
+    for video_path, future in zip(video_paths, futures):
+        try:
+            path = future.result()
+        except (subprocess.SubprocessError, OSError, ValueError, KeyError, IndexError) as e:
+            logging.error('Could not check or transcode ' + video_path + '. Not uploading')
+            logging.error(e)
+            continue
+
+        if path is None:
+            logging.error('Video ' + video_path + ' exceeds the limits of the instance. Not uploading')
+            continue
+
+        if path != video_path:
+            logging.debug('Using conformed video ' + path + ' for ' + video_path)
+        conformed.append(path)
+
+    return conformed
+
+
+def upload_video(session, mastodon, video_path):
+    """
+    Upload a video file to the Mastodon instance
+    Files larger than media_spool_threshold (or all of them with stream_media)
+    are sent with a chunked request body so that they are never loaded in memory
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :param video_path: path of video file
+    :return: media dict returned by the Mastodon API. None if the video could not be uploaded
+    """
+    from mastodon import MastodonAPIError, MastodonIllegalArgumentError
+
+    logging.debug('Uploading video ' + video_path + ' to Mastodon')
+    try:
+        with host_slot(mastodon.api_base_url):
+            if TOML['options']['stream_media'] or \
+                    os.path.getsize(video_path) > TOML['options']['media_spool_threshold']:
+                return stream_media_post(session, mastodon, _file_chunks(video_path),
+                                         os.path.basename(video_path), 'video/mp4')
+
+            with timed_stage('media_post'):
+                count_metric('media_uploads')
+                return mastodon.media_post(video_path, mime_type='video/mp4')
+
+    except (MastodonAPIError, MastodonIllegalArgumentError,
+            TypeError, OSError,
+            requests.exceptions.RequestException):  # Media cannot be uploaded (invalid format, dead link, etc.)
+        logging.error('Uploading video ' + video_path + ' failed')
+        return None
+
+
+def wait_for_media(mastodon, media_ids):
+    """
+    Wait until the Mastodon instance has finished processing uploaded media
+    The state of each media is polled with exponential backoff until
+    media_processing_timeout seconds have elapsed
+    :param mastodon: mastodon object returned by login()
+    :param media_ids: ids of media still being processed
+    :return: True if all the media are ready. False if processing failed or took too long
+    """
+    from mastodon import MastodonError
+
+    deadline = time.time() + TOML['options']['media_processing_timeout']
+    delay = 0.5
+    pending = list(media_ids)
+    while pending:
+        # Give the instance some time before checking again
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        delay = min(delay * 2, 8)
+
+        still_pending = []
+        for media_id in pending:
+            try:
+                media = mastodon.media(media_id)
+            except MastodonError as me:
+                # Processing failed (e.g. unsupported or corrupted file)
+                logging.error('Processing of media ' + str(media_id) + ' failed')
+                logging.error(me)
+                return False
+            if media.get('url') is None:
+                still_pending.append(media_id)
+        pending = still_pending
+
+        if pending and time.time() >= deadline:
+            logging.error('Media ' + ', '.join(str(m) for m in pending) + ' not processed after ' +
+                          str(TOML['options']['media_processing_timeout']) + ' seconds')
+            return False
+
+        if pending:
+            logging.debug('Waiting for processing of %d media', len(pending))
+
+    return True
+
+
+def upload_tweet_media(session, mastodon, tweet, caps):
+    """
+    Upload the media of a tweet and wait until the Mastodon instance has processed them
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :param tweet: dictionary with content of tweet built by process_status()
+    :param caps: capabilities of the instance returned by get_instance_capabilities()
+    :return: list of media ids, in the order of the tweet. None if the media could not be processed
+    """
+    logging.debug('Uploading media of Tweet %s', tweet["tweet_id"])
+
+    max_media = caps['max_media_attachments']
+    media_posted = []
+
+    # Upload videos if there are any. They are attached in the order of the tweet
+    if tweet['video']:
+        with timed_stage('conform'):
+            videos = conform_videos(tweet['video'][:max_media], caps)
+        with ThreadPoolExecutor(max_workers=TOML['options']['media_workers']) as pool:
+            for media in pool.map(lambda video: upload_video(session, mastodon, video), videos):
+                if media is not None:
+                    media_posted.append(media)
+
+    else:  # Only upload pic if no video was uploaded
+        # Download and upload photos concurrently. map() keeps the order of the attachments
+        with ThreadPoolExecutor(max_workers=TOML['options']['media_workers']) as pool:
+            for media in pool.map(lambda photo: upload_photo(session, mastodon, photo, caps),
+                                  tweet['photos'][:max_media]):
+                if media is not None:
+                    media_posted.append(media)
+
+    # Media still being processed by the instance have no url yet
+    pending = [media['id'] for media in media_posted if media.get('url') is None]
+    with timed_stage('media_wait'):
+        media_ready = wait_for_media(mastodon, pending)
+    if not media_ready:
+        logging.error('Media of tweet ' + tweet['tweet_id'] + ' could not be processed by ' +
+                      mastodon.api_base_url + '. Not posting')
+        return None
+
+    return [media['id'] for media in media_posted]
+
+
+def post_tweet(session, mastodon, tweet, in_reply_to_id=None, media_ids=None):
+    """
+    Upload the media of a tweet and post it on Mastodon
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :param tweet: dictionary with content of tweet built by process_status()
+    :param in_reply_to_id: id of the toot this one replies to. None if it is not a reply
+    :param media_ids: ids of media already uploaded by upload_tweet_media(). None to upload them
+    :return: posted toot. None if posting failed
+    """
+    from mastodon import MastodonError
+
+    logging.debug('Uploading Tweet %s', tweet["tweet_id"])
+
+    # Validate text and media against the limits of the instance before uploading anything
+    caps = get_instance_capabilities(session, mastodon)
+    tweet_text = trim_text(tweet['tweet_text'], caps)
+
+    if media_ids is None:
+        media_ids = upload_tweet_media(session, mastodon, tweet, caps)
+        if media_ids is None:
+            return None
+
+    # Post toot
+    toot = None
+    try:
+        with timed_stage('status_post'):
+            toot = mastodon.status_post(tweet_text, in_reply_to_id=in_reply_to_id,
+                                        media_ids=media_ids if len(media_ids) != 0 else None)
+
+    except MastodonError as me:
+        logging.error('posting ' + tweet['tweet_text'] + ' to ' +
+                      mastodon.api_base_url + ' Failed')
+        logging.error(me)
+        # The uploaded pictures can be attached when the tweet is tried again
+        media_id_release(mastodon, media_ids)
+
+    else:
+        logging.debug('Tweet %s posted on %s',
+                      tweet['tweet_id'], mastodon.api_base_url)
+        media_id_forget(mastodon, media_ids)
+
+    return toot
+
+
+def post_thread(session, mastodon, tweets, destination):
+    """
+    Post tweets of a thread as a chain of replies on Mastodon
+    The media of the next tweet are uploaded while the current one is being posted.
+    Tweets that were already mirrored are not posted again but the chain continues
+    from their toot. The chain stops at the first tweet that cannot be posted
+    :param session: HTTP client returned by build_session()
+    :param mastodon: mastodon object returned by login()
+    :param tweets: list of dictionaries with content of tweets built by process_status(), in thread order
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    :return: list of toots (or {'id': ...} for tweets already mirrored), one per tweet posted
+    """
+    caps = get_instance_capabilities(session, mastodon)
+    posted = [find_posted_toot(tweet['tweet_id'], destination) for tweet in tweets]
+
+    # A tweet that continues a thread mirrored earlier is chained to the toot of the tweet before it
+    toots = []
+    in_reply_to_id = None
+    if tweets[0].get('thread_parent') is not None:
+        in_reply_to_id = find_posted_toot(tweets[0]['thread_parent'], destination)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # At most 2 uploads run at the same time, so uploads stay just ahead of the posts
+        uploads = [None if toot_id is not None else pool.submit(upload_tweet_media, session, mastodon, tweet, caps)
+                   for tweet, toot_id in zip(tweets, posted)]
+
+        for tweet, toot_id, upload in zip(tweets, posted, uploads):
+            if toot_id is not None:
+                logging.info('Tweet ' + tweet['tweet_id'] + ' already posted as toot ' + toot_id)
+                toot = {'id': toot_id}
+            else:
+                media_ids = upload.result()
+                toot = None
+                if media_ids is not None:
+                    toot = post_tweet(session, mastodon, tweet, in_reply_to_id, media_ids)
+                if toot is None:
+                    logging.error('Thread interrupted at tweet ' + tweet['tweet_id'])
+                    for pending in uploads[uploads.index(upload) + 1:]:
+                        if pending is not None and not pending.cancel():
+                            # Pictures uploaded for the following tweets are reused at the next run
+                            media_id_release(mastodon, pending.result() or [])
+                    break
+                record_posted_toot(tweet['author_account'], tweet['tweet_id'], toot['id'], destination)
+
+            toots.append(toot)
+            in_reply_to_id = toot['id']
+
+    return toots
+
+
+def cleanup_output(status_id):
+    """
+    Remove the video files downloaded while processing a tweet
+    :param status_id: id of tweet whose files are removed
+    """
+    try:
+        shutil.rmtree(os.path.join('output', status_id))
+    except FileNotFoundError:  # The directory does not exist
+        pass
+
+
+def export_json(data):
+    """
+    Write tweet data to the file configured with export_json_path
+    :param data: tweet dictionary or list of tweet dictionaries
+    """
+    import json
+
+    jsonpath = TOML['options']['export_json_path']
+    with open(jsonpath, "w", encoding='utf-8') as jsonfile:
+        json.dump(data, jsonfile, indent=2, ensure_ascii=False)
+
+    logging.info('Exported Tweet JSON data to ' + jsonpath)
+
+
+def post_to_destination(session, destination, mastodon, tweet):
+    """
+    Post a tweet (and the rest of its thread with mirror_thread) on the account of a destination
+    Errors are contained so that they do not affect the other destinations
+    :param session: HTTP client returned by build_session()
+    :param destination: dictionary with mastodon_instance and mastodon_user of the account
+    :param mastodon: mastodon object returned by login(). None if login failed
+    :param tweet: dictionary with content of tweet built by process_status()
+    :return: toot of the tweet. None if it was not posted. With mirror_thread, None unless
+             the whole thread was posted
+    """
+    if mastodon is None:
+        logging.error('Not logged in to ' + destination['mastodon_instance'] + '. Tweet ' +
+                      tweet['tweet_id'] + ' not posted for ' + destination['mastodon_user'])
+        return None
+
+    try:
+        if TOML['options']['mirror_thread']:
+            thread = [tweet] + tweet['thread']
+            toots = post_thread(session, mastodon, thread, destination)
+            # An interrupted thread is resumed from its last toot by the next run
+            return toots[0] if len(toots) == len(thread) else None
+
+        toot = post_tweet(session, mastodon, tweet)
+        if toot is not None:
+            record_posted_toot(tweet['author_account'], tweet['tweet_id'], toot['id'], destination)
+        return toot
+
+    except Exception as e:  # Whatever happens on this destination, the others are served
+        logging.error('Posting tweet ' + tweet['tweet_id'] + ' for ' + destination['mastodon_user'] +
+                      ' failed: ' + repr(e))
+        return None
+
+
+def run_job(session, accounts, status_url, tweet=None, earlier_jobs=None):
+    """
+    Mirror one status: extract its content once and post it on the account of each destination
+    All the state of the job is local so that several jobs can run concurrently. A job of a status
+    that is already being mirrored waits for the other job and reports its toots. The destinations
+    are served concurrently and independently: a failure on one does not affect the others
+    :param session: requests session used to download from nitter
+    :param accounts: list of (destination, mastodon object) tuples returned by login_destinations().
+                     Empty to only extract the tweet, whose videos are then left in output/
+    :param status_url: full URL of the tweet
+    :param tweet: content of the tweet if it is already known (e.g. from an RSS feed).
+                  None to extract it from the nitter page of the status
+    :param earlier_jobs: dictionary of the futures of the jobs of the same pipeline, by status id.
+                         With mirror_thread, a status that continues the thread of an earlier one
+                         waits for its job, which posts it in the thread. None if there is none
+    :return: tuple (tweet, toots). toots has one item per account: the toot posted, a dictionary
+             with the id of the existing toot if the status was already mirrored, or None if it
+             was not posted. tweet is None if the status could not be processed or was already
+             mirrored on all the accounts. With mirror_thread, the toot of an account is the toot
+             of the status and None unless the whole thread was posted
+    """
+    job_start = time.time()
+    status_id = parse_status_url(status_url)[1]
+
+    def attempt(earlier_jobs):
+        with status_lock(status_id):
+            try:
+                return _mirror_status(session, accounts, status_url, tweet, job_start, earlier_jobs)
+
+            except Exception as e:  # A status that cannot be processed must not stop the other jobs
+                logging.error('Job for ' + status_url + ' failed: ' + repr(e))
+                # Files are removed before another job of the same status can write them
+                if accounts:
+                    cleanup_output(status_id)
+                count_metric('statuses_failed')
+                record_stage('job', time.time() - job_start)
+                return None, [None] * len(accounts)
+
+    outcome = attempt(earlier_jobs)
+    if isinstance(outcome, Future):
+        # No lock is held while waiting: the job of the thread needs the lock of this status
+        logging.info('Tweet ' + status_id + ' continues a thread mirrored by another job. Waiting for it')
+        outcome.result()
+        outcome = attempt(None)
+
+    return outcome
+
+
+def _mirror_status(session, accounts, status_url, tweet, job_start, earlier_jobs):
+    """
+    private function
+    Mirror one status. Same parameters and return value as run_job()
+    :param job_start: time at which the job started
+    :return: future of the job of the earlier tweet to wait for, if the status continues its thread
+    """
+    with ExitStack() as thread_locks:
+        return _mirror_status_locked(session, accounts, status_url, tweet, job_start, earlier_jobs, thread_locks)
+
+
+def _mirror_status_locked(session, accounts, status_url, tweet, job_start, earlier_jobs, thread_locks):
+    """
+    private function
+    Steps of _mirror_status()
+    :param thread_locks: ExitStack holding the locks of the following tweets of the thread
+    """
+    author_account, status_id = parse_status_url(status_url)
+
+    # Skip the accounts on which the status was already mirrored before doing any network request.
+    # A thread is read again as the author may have continued it
+    toots = [None] * len(accounts)
+    if not TOML['options']['mirror_thread']:
+        for index, (destination, mastodon) in enumerate(accounts):
+            toot_id = find_posted_toot(status_id, destination)
+            if toot_id is not None:
+                logging.info('Tweet ' + status_id + ' already posted as toot ' + toot_id + ' for ' +
+                             destination['mastodon_user'])
+                toots[index] = {'id': toot_id}
+        if accounts and None not in toots:
+            logging.info('Tweet ' + status_id + ' already mirrored. Skipping')
+            count_metric('statuses_skipped')
+            return None, toots
+    pending = [index for index, toot in enumerate(toots) if toot is None]
+
+    # Nothing to extract for if none of the remaining accounts is logged in
+    if tweet is None and (not accounts or any(accounts[index][1] is not None for index in pending)):
+        tweet = process_status(session, status_url, thread_locks)
+
+    # The job of the start of the thread posts this tweet as a reply. Posting it now would split the thread
+    parent_id = tweet.get('thread_parent') if tweet is not None else None
+    if earlier_jobs is not None and parent_id is not None and pending \
+            and _status_key(parent_id) < _status_key(status_id) and parent_id in earlier_jobs:
+        if accounts:
+            cleanup_output(status_id)
+            for reply in tweet['thread']:
+                cleanup_output(reply['tweet_id'])
+        return earlier_jobs[parent_id]
+
+    if tweet is not None and pending:
+        posted_tweet = tweet
+        # Pictures are downloaded once if they are uploaded to several accounts
+        if sum(1 for index in pending if accounts[index][1] is not None) > 1:
+            posted_tweet = stage_photos(session, tweet)
+            if TOML['options']['mirror_thread']:
+                posted_tweet['thread'] = [stage_photos(session, reply) for reply in tweet['thread']]
+
+        # The locks of the following tweets of the thread, taken by process_status(), are held until
+        # their files are removed. A job of one of them then finds it in the database and does not post it again
+        with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+            posted = pool.map(lambda index: post_to_destination(session, *accounts[index], posted_tweet), pending)
+            for index, toot in zip(pending, posted):
+                toots[index] = toot
+
+    # Cleanup downloaded video and picture files. Exported tweets refer to their videos
+    if accounts:
+        cleanup_output(status_id)
+        if tweet is not None:
+            for reply in tweet.get('thread', []):
+                cleanup_output(reply['tweet_id'])
+
+    if tweet is None or None in toots:
+        count_metric('statuses_failed')
+    else:
+        count_metric('statuses_mirrored')
+    record_stage('job', time.time() - job_start)
+
+    logging.info('Job for {s} completed in {t:2.1f} seconds'.format(
+        s=status_url, t=time.time() - job_start))
+
+    return tweet, toots
+
+
+def run_pipeline(session, accounts, statuses, tweets=None):
+    """
+    Mirror statuses concurrently. Batches, polls and single statuses all go through it
+    At most max_concurrent_jobs statuses are in progress at any time. All the stages
+    of each job (fetch, parse, link resolution, media, post) run in a worker thread
+    and the workers share the pooled HTTP client. A status listed several times is
+    only mirrored once
+    :param session: HTTP client returned by build_session()
+    :param accounts: list of (destination, mastodon object) tuples returned by login_destinations().
+                     Empty to only extract the tweets
+    :param statuses: list of status URLs
+    :param tweets: dictionary of tweets already built, by status URL. None if there is none
+    :return: list of (tweet, toots) tuples returned by run_job(), in the order of statuses
+    """
+    tweets = tweets or {}
+
+    # One job per status id. Jobs start in chronological order, so that the job of the start of
+    # a thread is running when the jobs of its following tweets wait for it
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=TOML['options']['max_concurrent_jobs']) as pool:
+        for status_url in sorted(statuses, key=lambda url: _status_key(parse_status_url(url)[1])):
+            status_id = parse_status_url(status_url)[1]
+            if status_id not in jobs:
+                jobs[status_id] = pool.submit(run_job, session, accounts, status_url, tweets.get(status_url), jobs)
+
+    return [jobs[parse_status_url(status_url)[1]].result() for status_url in statuses]
+
+
+def run_batch(session, statuses, mast_password, tweets=None):
+    """
+    Mirror a list of statuses concurrently with a single session and a single login per destination
+    :param session: requests session shared by all downloads from nitter
+    :param statuses: list of status URLs
+    :param mast_password: Password associated to mastodon account. None if not provided
+    :param tweets: dictionary of tweets already built, by status URL. None if there is none
+    :return: list of (status URL, destination, result) tuples, one per status and destination.
+             result is the toot id or None if failed. When exporting, there is one tuple per
+             status with None as destination and result is 'exported' or None if failed
+    """
+    exporting = TOML['options']['export_json_path'] != ''
+
+    accounts = []
+    if not exporting:
+        # Login once for the whole batch
+        accounts = login_destinations(session, mast_password)
+
+    results = []
+    exported = []
+    outcomes = run_pipeline(session, accounts, statuses, tweets)
+    for status_url, (tweet, toots) in zip(statuses, outcomes):
+        if exporting:
+            result = None
+            if tweet is not None:
+                exported.append(tweet)
+                result = 'exported'
+            results.append((status_url, None, result))
+
+        for (destination, mastodon), toot in zip(accounts, toots):
+            results.append((status_url, destination, toot['id'] if toot is not None else None))
+
+    if exporting:
+        export_json(exported)
+
+    return results
+
+
+def report_results(results):
+    """
+    Print and log the result of each status of a batch
+    :param results: list of (status URL, destination, result) tuples returned by run_batch()
+    :return: number of results that are failures
+    """
+    failed = 0
+    for status_url, destination, result in results:
+        # Name the account only if there are several
+        account = ''
+        if destination is not None and len(TOML['destinations']) > 1:
+            account = ' (' + destination['mastodon_user'] + ' on ' + destination['mastodon_instance'] + ')'
+
+        if result is None:
+            failed += 1
+            logging.error('FAILED   ' + status_url + account)
+            print('FAILED   ' + status_url + account)
+        else:
+            logging.info('OK       ' + status_url + ' -> ' + str(result) + account)
+            print('OK       ' + status_url + ' -> ' + str(result) + account)
+
+    return failed
+
+
+def run_daemon(session, accounts, port):
+    """
+    Serve status submissions on a local HTTP endpoint until interrupted
+    The session and the mastodon objects are shared by all the jobs.
+    POST /status with JSON body {"url": "<twitter status>", "export": false}
+    returns {"status": ..., "toot_id": ...} or {"status": ..., "tweet": {...}} if export is true.
+    With several destinations, "toots" lists the toot id (or null) of each destination
+    :param session: requests session used to download from nitter
+    :param accounts: list of (destination, mastodon object) tuples returned by login_destinations().
+                     Empty if only exporting
+    :param port: TCP port to listen on. Only the loopback interface is used
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class SubmissionHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/status':
+                self.send_json(404, {'error': 'Unknown endpoint ' + self.path})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+                status_url = request['url']
+                export = bool(request.get('export', False))
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {'error': 'Expected JSON body with "url" key'})
+                return
+
+            if not export and not accounts:
+                self.send_json(400, {'error': 'Not logged in to a Mastodon instance. Only export is possible'})
+                return
+
+            logging.info('Received job for ' + status_url)
+            tweet, toots = run_job(session, [] if export else accounts, status_url)
+            write_metrics()
+
+            response = {'status': status_url}
+            if len(toots) > 1:
+                response['toots'] = [{'mastodon_instance': destination['mastodon_instance'],
+                                      'mastodon_user': destination['mastodon_user'],
+                                      'toot_id': str(toot['id']) if toot is not None else None}
+                                     for (destination, mastodon), toot in zip(accounts, toots)]
+
+            if toots and None not in toots:
+                response['toot_id'] = str(toots[0]['id'])
+                self.send_json(200, response)
+            elif tweet is None:
+                response['error'] = 'Status could not be processed'
+                self.send_json(502, response)
+            elif export:
+                response['tweet'] = tweet
+                self.send_json(200, response)
+            else:
+                response['error'] = 'Posting on Mastodon failed'
+                self.send_json(502, response)
+
+        def log_message(self, format, *args):
+            logging.debug('daemon: ' + format, *args)
+
+    def stop_daemon(signum, frame):
+        raise KeyboardInterrupt
+
+    # Stop cleanly when the service manager terminates the process
+    signal.signal(signal.SIGTERM, stop_daemon)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), SubmissionHandler)
+    logging.info('Listening for submissions on http://127.0.0.1:%d/status', port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Daemon interrupted. Shutting down')
+    finally:
+        server.server_close()
+
+
+def main(argv):
+    # Start stopwatch
+    global START_TIME
+    START_TIME = time.time()
+
+    # Build parser for command line arguments
+    parser = argparse.ArgumentParser(description='toot tweets.')
+    parser.add_argument('-f', metavar='<.toml config file>', action='store')
+    parser.add_argument('-t', metavar='<twitter status>', action='store')
+    parser.add_argument('-a', metavar='<twitter account>', action='store',
+                        help='Mirror the statuses of the account posted since the previous run')
+    parser.add_argument('-b', metavar='<file with list of twitter statuses>', action='store',
+                        help="Mirror every status listed in file ('-' for stdin)")
+    parser.add_argument('-d', metavar='<port>', type=int, action='store',
+                        help='Run as daemon accepting statuses on http://127.0.0.1:<port>/status')
+    parser.add_argument('-i', metavar='<mastodon instance>', action='store')
+    parser.add_argument('-m', metavar='<mastodon account>', action='store')
+    parser.add_argument('-p', metavar='<mastodon password>', action='store')
+    parser.add_argument('-l', action='store_true',
+                        help='Remove link redirection')
+    parser.add_argument('-u', action='store_true',
+                        help='Remove trackers from URLs')
+    parser.add_argument('-v', action='store_true',
+                        help='Ingest twitter videos and upload to Mastodon instance')
+    parser.add_argument('-o', action='store_true',
+                        help='Do not add reference to Original tweet')
+    parser.add_argument('-r', action='store_true',
+                        help='Also mirror the following tweets of the thread of the author')
+    parser.add_argument('-j', metavar='<json export path>', action='store')
+
+    parser.add_argument('-n', action='store_true',
+                        help='List health scores of nitter instances and exit')
+
+    # Parse command line
+    args = vars(parser.parse_args())
+
+    if args['n']:
+        print_nitter_health()
+        exit(0)
+
+    build_config(args)
+
+    mast_password = args['p']
+
+    # Setup logging to daily files
+    log_handler = DailyLogHandler('twoot.log', TOML['options']['log_days'])
+    log_handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    ))
+    logger = logging.getLogger()
+    logger.addHandler(log_handler)
+
+    # log level as an uppercase string from config
+    ll_str = TOML['options']['log_level'].upper()
+
+    log_level = logging.WARNING
+    if ll_str == "DEBUG":
+        log_level = logging.DEBUG
+    elif ll_str == "INFO":
+        log_level = logging.INFO
+    elif ll_str == "WARNING":
+        log_level = logging.WARNING
+    elif ll_str == "ERROR":
+        log_level = logging.ERROR
+    elif ll_str == "CRITICAL":
+        log_level = logging.CRITICAL
+    elif ll_str == "OFF":
+        # Disable all logging
+        logging.disable(logging.CRITICAL)
+    else:
+        logging.error('Invalid log_level %s in config file. Using WARNING.', str(
+            TOML['options']['log_level']))
+
+    # Set desired level of logging
+    logger.setLevel(log_level)
+
+    logging.info('Running with the following configuration:')
+    logging.info('  Config File              : ' + str(args['f']))
+    if 'twitter_status' in TOML['config'].keys():
+        logging.info('  twitter_status          : ' +
+                     TOML['config']['twitter_status'])
+    if TOML['config'].get('twitter_account', '') != '':
+        logging.info('  twitter_account          : ' +
+                     TOML['config']['twitter_account'])
+    if args['b'] is not None:
+        logging.info('  batch file               : ' + args['b'])
+    if args['d'] is not None:
+        logging.info('  daemon port              : ' + str(args['d']))
+
+    for destination in TOML['destinations']:
+        logging.info('  mastodon_instance        : ' + destination['mastodon_instance'])
+        logging.info('  mastodon_user            : ' + destination['mastodon_user'])
+
+    logging.info('  upload_videos            : ' +
+                 str(TOML['options']['upload_videos']))
+    logging.info('  remove_link_redirections : ' +
+                 str(TOML['options']['remove_link_redirections']))
+    logging.info('  remove_trackers_from_urls: ' +
+                 str(TOML['options']['remove_trackers_from_urls']))
+    logging.info('  footer                   : ' + TOML['options']['footer'])
+    logging.info('  remove_original_tweet_ref: ' +
+                 str(TOML['options']['remove_original_tweet_ref']))
+    logging.info('  mirror_thread            : ' +
+                 str(TOML['options']['mirror_thread']))
+    logging.info('  subst_twitter            : ' +
+                 str(TOML['options']['subst_twitter']))
+    logging.info('  subst_twitter            : ' +
+                 str(TOML['options']['subst_youtube']))
+    logging.info('  subst_twitter            : ' +
+                 str(TOML['options']['subst_reddit']))
+    logging.info('  log_level                : ' +
+                 str(TOML['options']['log_level']))
+    logging.info('  log_days                 : ' +
+                 str(TOML['options']['log_days']))
+    logging.info('  export_json_path                 : ' +
+                 str(TOML['options']['export_json_path']))
+
+    # Initiate HTTP client used for all network requests
+    session = build_session()
+
+    # **********************************************************
+    # Batch mode: mirror all statuses listed in file
+    # **********************************************************
+    if args['b'] is not None:
+        statuses = read_status_list(args['b'])
+        logging.info('Mirroring %d statuses in batch mode', len(statuses))
+
+        results = run_batch(session, statuses, mast_password)
+        failed = report_results(results)
+
+        logging.info('Batch complete: %d succeeded, %d failed',
+                     len(results) - failed, failed)
+        terminate(0 if failed == 0 else 1)
+
+    # **********************************************************
+    # Polling mode: mirror the new statuses of an account
+    # **********************************************************
+    if TOML['config'].get('twitter_status', '') == '' and TOML['config'].get('twitter_account', '') != '' \
+            and args['d'] is None:
+        twitter_account = TOML['config']['twitter_account']
+        polled = poll_timeline(session, twitter_account)
+        if polled is None:
+            terminate(-1)
+        statuses, tweets = polled
+
+        # Nothing to log in for if there is nothing new
+        results = []
+        if statuses:
+            results = run_batch(session, statuses, mast_password, tweets)
+        failed = report_results(results)
+
+        # Move the mark of each destination up to the first status that failed on it
+        # so that it is retried next time
+        for destination in timeline_destinations():
+            mark = get_timeline_mark(twitter_account, destination)
+            for status_url, result_destination, result in results:
+                if result_destination is not None and result_destination is not destination:
+                    continue
+                if result is None:
+                    break
+                status_id = parse_status_url(status_url)[1]
+                if mark is None or int(status_id) > int(mark):
+                    set_timeline_mark(twitter_account, status_id, destination)
+
+        logging.info('Poll complete: %d succeeded, %d failed',
+                     len(results) - failed, failed)
+        terminate(0 if failed == 0 else 1)
+
+    # **********************************************************
+    # Daemon mode: keep session and login warm between jobs
+    # **********************************************************
+    if args['d'] is not None:
+        accounts = []
+        if TOML['options']['export_json_path'] == '':
+            accounts = login_destinations(session, mast_password)
+
+        run_daemon(session, accounts, args['d'])
+        terminate(0)
+
+    # **********************************************************
+    # Load twitter page of status and extract its content
+    # **********************************************************
+    if TOML['options']['export_json_path'] != '':
+        tweet, toots = run_pipeline(session, [], [TOML['config']['twitter_status']])[0]
+        if tweet is None:
+            terminate(-1)
+
+        export_json(tweet)
+        terminate(0)
+
+    # Login to accounts on mastodon instances
+    accounts = login_destinations(session, mast_password)
+
+    # **********************************************************
+    # Post tweet on Mastodon
+    # **********************************************************
+    tweet, toots = run_pipeline(session, accounts, [TOML['config']['twitter_status']])[0]
+    if tweet is None and all(toot is None for toot in toots):
+        terminate(-1)
 
     terminate(0)
 